@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# vim: set expandtab:
+
+# Benchmarks the modules in library/ on a laptop, against bench/pfSsh.php
+# and a config from bench/genconfig.py instead of a firewall.
+#
+#   bench/bench.py                                   # 10, 1000 & 10000 items
+#   bench/bench.py 10 100 --repeat 3 --case aliases
+#
+# Needs ansible (pip install ansible-core) and php-cli. Each run gets a fresh copy of
+# the generated config and runs the module in its own python process, as Ansible would
+# on the firewall, with PFSENSE_TIMINGS set. The timings it returns count the PHP
+# shells started and the requests made to them.
+
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, here)
+
+from genconfig import generate, rule, alias, cert, tracker, bgpd
+
+
+def changed_rule(i):
+    r = rule(i)
+    r['descr'] = 'bench rule changed'
+    return r
+
+
+def changed_alias(i):
+    a = alias(i)
+    a['address'] += ' 192.0.2.1'
+    a['detail'] += '||added'
+    return a
+
+
+# name: list of (module, args) steps, given the number of items in the config
+cases = [
+    ('filter_rules bulk, none changed', lambda n: [
+        ('pfsense_filter_rules', dict(rules=[rule(i) for i in range(n)]))]),
+    ('filter_rules bulk, one changed', lambda n: [
+        ('pfsense_filter_rules', dict(rules=[rule(i) for i in range(n - 1)] + [changed_rule(n - 1)]))]),
+    ('filter_rules single', lambda n: [
+        ('pfsense_filter_rules', changed_rule(n - 1))]),
+    ('filter_audit', lambda n: [
+        ('pfsense_filter_audit', dict(rules=[dict(tracker=tracker(i)) for i in range(n)]))]),
+    ('aliases bulk, one changed', lambda n: [
+        ('pfsense_aliases', dict(aliases=[alias(i) for i in range(n - 1)] + [changed_alias(n - 1)]))]),
+    ('aliases single', lambda n: [
+        ('pfsense_aliases', changed_alias(n - 1))]),
+    ('cert add', lambda n: [
+        ('pfsense_cert', cert(n))]),
+    ('virtualip add', lambda n: [
+        ('pfsense_virtualip', dict(subnet='198.51.100.1'))]),
+    ('groups bulk, one added', lambda n: [
+        ('pfsense_group', dict(groups=[dict(name='bench_group_' + str(i), priv=['page-dashboard-all', 'page-help-all'])
+                                       for i in range(n - 1)] + [dict(name='bench_group_new', priv=['page-all'])]))]),
+    ('group add', lambda n: [
+        ('pfsense_group', dict(name='bench_group_new', priv=['page-dashboard-all']))]),
+    ('authserver add', lambda n: [
+        ('pfsense_authserver', dict(refid='5effffffffffff', name='bench new', host='ldap.example.com'))]),
+    ('password', lambda n: [
+        ('pfsense_password', dict(username='bench_user_0', password='bench'))]),
+    ('config', lambda n: [
+        ('pfsense_config', dict(system=dict(hostname='bench2')))]),
+    ('interfaces', lambda n: [
+        ('pfsense_interfaces', dict(name='lan', ipaddr='192.168.1.2', subnet='24'))]),
+    ('frr_raw, one changed', lambda n: [
+        ('pfsense_frr_raw', dict(bgpd=bgpd(n, n - 1)))]),
+    ('frr_raw, one changed, full', lambda n: [
+        ('pfsense_frr_raw', dict(bgpd=bgpd(n, n - 1), reload='full'))]),
+    ('apply', lambda n: [
+        ('pfsense_apply', dict(services=['hostname']))]),
+    ('transaction', lambda n: [
+        ('pfsense_commit', dict(state='begin')),
+        ('pfsense_filter_rules', changed_rule(n - 1)),
+        ('pfsense_aliases', changed_alias(n - 1)),
+        ('pfsense_commit', dict(state='commit'))]),
+]
+
+
+def run_step(module, args, config, state):
+    # one module run, in a process of its own, returns (seconds, result)
+    fd, args_file = tempfile.mkstemp(suffix='.json', dir=state)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict(ANSIBLE_MODULE_ARGS=args), f)
+    env = dict(os.environ, PFSENSE_TIMINGS='yes', PFSENSE_BENCH_CONFIG=config, PFSENSE_BENCH_STATE=state)
+    begin = time.time()
+    proc = subprocess.Popen([sys.executable, __file__, '--run', module, args_file],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    seconds = time.time() - begin
+    os.remove(args_file)
+    try:
+        result = json.loads(out.decode('utf-8').strip().split('\n')[-1])
+    except ValueError:
+        result = dict(failed=True, msg='no result', stdout=out.decode('utf-8', 'replace'), stderr=err.decode('utf-8', 'replace'))
+    return seconds, result
+
+
+def run_case(steps, source, work):
+    # the steps of a case against a fresh copy of the config, returns a row of totals
+    state = tempfile.mkdtemp(dir=work)
+    config = os.path.join(state, 'config.json')
+    shutil.copy(source, config)
+    row = dict(seconds=0.0, php=0.0, starts=0, requests=0, sent=0, received=0, changed=False)
+    for module, args in steps:
+        seconds, result = run_step(module, args, config, state)
+        if result.get('failed'):
+            shutil.rmtree(state)
+            raise RuntimeError(module + ': ' + json.dumps(result)[:2000])
+        row['seconds'] += seconds
+        row['changed'] = row['changed'] or result.get('changed', False)
+        for phase, t in result.get('timings', {}).items():
+            if phase == 'start':
+                row['starts'] += t['calls']
+                row['php'] += t['seconds']
+            elif 'sent' in t:
+                row['requests'] += t['calls']
+                row['php'] += t['seconds']
+                row['sent'] += t['sent']
+                row['received'] += t['received']
+    shutil.rmtree(state)
+    return row
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def bench(sizes, repeat, only, as_json):
+    work = tempfile.mkdtemp(prefix='pfsense-bench-')
+    try:
+        if not as_json:
+            print('%-34s %6s %9s %9s %6s %8s %10s %10s %7s' % (
+                'case', 'items', 'seconds', 'php', 'starts', 'requests', 'sent', 'received', 'changed'))
+        for n in sizes:
+            source = os.path.join(work, 'config-%d.json' % n)
+            with open(source, 'w') as f:
+                json.dump(generate(n), f)
+            for name, steps in cases:
+                if only and not any(o in name for o in only):
+                    continue
+                rows = [run_case(steps(n), source, work) for r in range(repeat)]
+                row = dict(rows[0], seconds=median([r['seconds'] for r in rows]), php=median([r['php'] for r in rows]))
+                if as_json:
+                    print(json.dumps(dict(row, case=name, items=n)))
+                else:
+                    print('%-34s %6d %9.3f %9.3f %6d %8d %10d %10d %7s' % (
+                        name, n, row['seconds'], row['php'], row['starts'], row['requests'],
+                        row['sent'], row['received'], row['changed']))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(work)
+
+
+def run(module, args_file):
+    # Child side: run one module the way Ansible would, with module_utils/pfsense.py
+    # pointed at the stand-in shell and a scratch state directory.
+    import ansible.module_utils
+    from ansible.module_utils import basic
+
+    spec = importlib.util.spec_from_file_location('ansible.module_utils.pfsense', os.path.join(root, 'module_utils', 'pfsense.py'))
+    pfsense = importlib.util.module_from_spec(spec)
+    sys.modules['ansible.module_utils.pfsense'] = pfsense
+    ansible.module_utils.pfsense = pfsense
+    spec.loader.exec_module(pfsense)
+
+    state = os.environ['PFSENSE_BENCH_STATE']
+    pfsense.cmd = os.path.join(here, 'pfSsh.php')
+    pfsense.config_file = os.environ['PFSENSE_BENCH_CONFIG']
+    pfsense.state_dir = state
+    pfsense.cache_dir = os.path.join(state, 'cache')
+    pfsense.queue_file = os.path.join(state, 'transaction.queue')
+    pfsense.snapshot_file = os.path.join(state, 'transaction.snapshot')
+    platform.system = lambda: 'FreeBSD'     # pfsense_check() wants the firewall's OS
+
+    with open(args_file, 'rb') as f:
+        basic._ANSIBLE_ARGS = f.read()
+    basic._ANSIBLE_PROFILE = 'legacy'   # ansible-core 2.19 wants one, older ones ignore it
+    sys.path.insert(0, os.path.join(root, 'library'))
+    loaded = importlib.import_module(module)
+    # modules that run programs or include package files get the stand-ins
+    for name, path in [('vtysh', os.path.join(here, 'vtysh')), ('frr_inc', os.path.join(here, 'inc', 'frr.inc'))]:
+        if hasattr(loaded, name):
+            setattr(loaded, name, path)
+    loaded.main()
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3])
+        return
+    parser = argparse.ArgumentParser(description='Benchmark the pfsense modules against a stand-in pfSsh.php')
+    parser.add_argument('sizes', nargs='*', type=int, default=[10, 1000, 10000], help='items per collection in the config')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case, the median is reported')
+    parser.add_argument('--case', action='append', help='only run cases whose name contains this, may be repeated')
+    parser.add_argument('--json', action='store_true', help='one JSON object per case instead of a table')
+    options = parser.parse_args()
+    bench(options.sizes, options.repeat, options.case, options.json)
+
+
+if __name__ == '__main__':
+    main()
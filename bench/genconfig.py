@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# vim: set expandtab:
+
+# Synthetic pfSense $config for the benchmarks, as the JSON pfSsh.php's json_encode() would give.
+#
+#   bench/genconfig.py 1000 > /tmp/config.json
+#
+# Every collection (rules, aliases, certs, vips, users, groups, authservers, BGP neighbors)
+# gets N entries.
+# The rule(), alias() etc. helpers are shared with bench.py, so a task built from them
+# matches what is in the config and only the entries a case changes are a diff.
+
+import base64
+import json
+import sys
+
+
+def tracker(i):
+    return str(1500000000 + i)
+
+
+def rule(i):
+    return dict(
+        type='pass',
+        tracker=tracker(i),
+        ipprotocol='inet',
+        interface=['lan', 'wan', 'opt1'][i % 3],
+        direction='any',
+        statetype='keep state',
+        protocol='tcp',
+        descr='bench rule ' + str(i),
+        source=dict(network='lan'),
+        destination=dict(address='10.%d.%d.1' % (i // 256 % 256, i % 256), port=str(1024 + i % 60000)),
+    )
+
+
+def alias(i):
+    return dict(
+        name='bench_alias_' + str(i),
+        type='host',
+        address=' '.join('10.%d.%d.%d' % (i // 256 % 256, i % 256, h) for h in range(1, 5)),
+        descr='',
+        detail='||'.join('host ' + str(h) for h in range(1, 5)),
+    )
+
+
+def blob(i, size):
+    # base64 of about the size of a real PEM cert or key
+    raw = (('bench %d ' % i) * size)[:size]
+    return base64.b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def cert(i):
+    return dict(
+        refid='%013x' % (0x5c0000000000 + i),
+        descr='bench cert ' + str(i),
+        type='server',
+        crt=blob(i, 1400),
+        prv=blob(i, 1700),
+    )
+
+
+def vip(i):
+    return dict(
+        mode='ipalias',
+        type='single',
+        uniqid='%013x' % (0x5d0000000000 + i),
+        interface='lo0',
+        descr='',
+        subnet='172.%d.%d.%d' % (16 + i // 65536 % 16, i // 256 % 256, i % 256),
+        subnet_bits='32',
+        vhid='',
+        password='',
+        advbase='1',
+        advskew='0',
+    )
+
+
+def user(i):
+    return dict(
+        name='bench_user_' + str(i),
+        descr='',
+        scope='user',
+        uid=str(2000 + i),
+        groupname='bench_group_' + str(i % 10),
+        authorizedkeys='',
+    )
+
+
+def group(i):
+    return dict(
+        name='bench_group_' + str(i),
+        description='',
+        scope='remote',
+        gid=str(2000 + i),
+        priv=['page-dashboard-all', 'page-help-all'],
+    )
+
+
+def authserver(i):
+    return dict(
+        refid='%013x' % (0x5e0000000000 + i),
+        type='ldap',
+        name='bench ldap ' + str(i),
+        host='ldap%d.example.com' % i,
+        ldap_port='389',
+    )
+
+
+def bgpd(n, changed=None):
+    # a raw bgpd config of n neighbors, base64 encoded as pfsense_frr_raw takes it,
+    # neighbor number changed with another description
+    lines = ['router bgp 64512', ' bgp router-id 192.0.2.1']
+    for i in range(n):
+        peer = '10.%d.%d.%d' % (128 + i // 65536 % 64, i // 256 % 256, i % 256)
+        lines += [' neighbor %s remote-as %d' % (peer, 64513 + i % 1000), ' neighbor %s description bench peer %d%s' % (peer, i, ' changed' if i == changed else '')]
+    lines += [' !', ' address-family ipv4 unicast', '  network 192.0.2.0/24', ' exit-address-family', '!', 'line vty', '!']
+    return base64.b64encode(('\n'.join(lines) + '\n').encode('utf-8')).decode('ascii')
+
+
+def generate(n):
+    admin = dict(name='admin', descr='System Administrator', scope='system', uid='0', groupname='admins',
+                 priv=['user-shell-access'], authorizedkeys='')
+    admins = dict(name='admins', description='System Administrators', scope='system', gid='1999',
+                  member=['0'], priv=['page-all'])
+    return dict(
+        version='19.1',
+        system=dict(
+            hostname='bench',
+            domain='example.com',
+            timezone='Etc/UTC',
+            nextuid=str(2000 + n),
+            nextgid=str(2000 + n),
+            user=[admin] + [user(i) for i in range(n)],
+            group=[admins] + [group(i) for i in range(n)],
+            authserver=[authserver(i) for i in range(n)],
+        ),
+        interfaces=dict(
+            wan=dict(enable='', ipaddr='dhcp', descr='WAN'),
+            lan=dict(enable='', ipaddr='192.168.1.1', subnet='24', descr='LAN'),
+            opt1=dict(ipaddr='192.168.2.1', subnet='24', descr='OPT1'),
+        ),
+        gateways=dict(gateway_item=[dict(interface='wan', gateway='203.0.113.1', name='Default_GW', weight='1')]),
+        filter=dict(rule=[rule(i) for i in range(n)]),
+        aliases=dict(alias=[alias(i) for i in range(n)]),
+        cert=[cert(i) for i in range(n)],
+        virtualip=dict(vip=[vip(i) for i in range(n)]),
+        snmpd=dict(syslocation='', syscontact='', rocommunity='public', pollport='161'),
+        syslog=dict(nentries='50'),
+        installedpackages=dict(
+            frr=dict(config=[dict(enable='on', password='bench')]),
+            frrbgp=dict(config=[dict(enable='on')]),
+            frrglobalraw=dict(config=[dict(bgpd=bgpd(n))]),
+        ),
+    )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: genconfig.py N')
+    json.dump(generate(int(sys.argv[1])), sys.stdout)
@@ -0,0 +1,40 @@
+#!/usr/bin/env php
+<?php
+/*
+ * Stand-in for /usr/local/sbin/pfSsh.php, so the modules can be benchmarked without a firewall.
+ *
+ * $config is loaded from the JSON file named by PFSENSE_BENCH_CONFIG and write_config() saves
+ * it back there. Lines are collected until "exec", then run with eval() in global scope like
+ * the real shell, "exit" quits. The pfSense functions the modules call are stubs, see inc/.
+ */
+
+$config_file = getenv('PFSENSE_BENCH_CONFIG');
+if (!$config_file || !is_readable($config_file)) {
+	fwrite(STDERR, "PFSENSE_BENCH_CONFIG must name a JSON config, see bench/genconfig.py\n");
+	exit(1);
+}
+$config = json_decode(file_get_contents($config_file), true);
+
+set_include_path(__DIR__ . '/inc' . PATH_SEPARATOR . get_include_path());
+require_once('stubs.inc');
+
+echo "\nStarting the pfSense developer shell....\n";
+
+$buffer = "";
+while (true) {
+	echo "pfSense shell: ";
+	$line = fgets(STDIN);
+	if ($line === false) {
+		break;
+	}
+	$command = trim($line);
+	if ($command == 'exit') {
+		break;
+	}
+	if ($command == 'exec' || $command == 'exec;') {
+		eval($buffer);
+		$buffer = "";
+	} else {
+		$buffer .= $line;
+	}
+}
@@ -22,6 +22,15 @@ description:
     If safe mode is turned off, new keys can be created, if done incorrectly, could produce strange results.
     To determine what can be loaded, save a prefconfigured pfSense Firewall confuration xml file and convert it to yaml.
   - CAN NOT be used to unset an option such as $config['system']['dnsallowoverride']);
+  - Given a list in 'aliases', the aliases section is read once and all adds, updates and
+    deletes are written with a single write_config(). With exclusive: yes, aliases found
+    in the firewall that are not in the list are removed, exclusive needs 'aliases'.
+  - The aliases section is returned as computed by the module, it is not read back after
+    the write. Set verify: yes to have the firewall check its copy against it.
+  - By default the returned section only holds the aliases given to the task,
+    return_state: section returns every alias and return_state: none nothing.
+  - address is space separated and detail || separated, one detail per address.
+    detail '' clears the detail of every address, leaving detail out keeps them.
 
 version_added: "2.7"
 
@@ -54,6 +63,22 @@ ansible_python_interpreter=/usr/local/bin/python2.7
 '''
 
 EXAMPLES = '''
+# addresses can be a list, each entry optionally with its own detail.
+# Entries are compared as a set, order and whitespace don't matter.
+- pfsense_aliases:
+    name: DNS_Servers
+    type: host
+    address:
+      - address: 8.8.8.8
+        detail: google
+      - address: 1.1.1.1
+        detail: cloudflare
+
+# every alias in one task, removing any alias not in the list
+- pfsense_aliases:
+    aliases: "{{ fw_aliases }}"
+    exclusive: yes
+
 vars:
   alias:
     descr: "YYYY myalias.domain.com"
@@ -70,83 +95,242 @@ tasks:
 '''
 
 RETURN = '''
-section:
-    description: dict containing data structure for that section
+aliases:
+    description: dict containing data structure for the aliases section, only this task's aliases unless return_state=section
+alias_status:
+    description: in bulk mode, list of name, state, changed & entry counts for each alias, including any removed by exclusive
+added:
+    description: number of address entries added
+removed:
+    description: number of address entries removed
+detail:
+    description: number of existing address entries whose detail changed
 debug:
     description: Any debug messages for unexpected input types
     type: str
+changes:
+    description: with --diff, the changes made to the aliases section as a list of op, path & value
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, search, pfsense_check, validate, isstr
+from ansible.module_utils.pfsense import write_config, read_config, verify_config, return_state, Index, pfsense_check, isstr, bulk_items, mark_dirty, php_path, php_value, php_merge, ChangeSet, changes_result, add_timings, timed
+from collections import OrderedDict
+
+
+alias_args = dict(
+    state=dict(required=False, default='present', choices=['present', 'absent']),
+    name=dict(required=True),
+    address=dict(required=False, type='raw'),  # string or list
+    descr=dict(required=False, default=''),
+    type=dict(required=True, choices=['host', 'network', 'port', 'url', 'url_ports', 'urltable', 'urltable_ports']),
+    detail=dict(required=False, type='raw'),  # string or list
+)
+
+
+def alias_entries(module, address, detail, check=True):
+    # address as a space separated string or a list (of strings or dicts with address & detail),
+    # detail as a || separated string or a list. Returns an ordered dict of address -> detail,
+    # detail is None where none was given. An empty detail string clears the detail of every
+    # entry, otherwise there has to be one detail per address.
+
+    entries = OrderedDict()
+    if address is None:
+        return entries
+    if isstr(address):
+        address = address.split()
+    if isstr(detail):
+        detail = [''] * len(address) if detail == '' else detail.split('||')
+    if check and type(detail) is list and len(detail) != len(address):
+        module.fail_json(msg='alias has %d addresses but %d details' % (len(address), len(detail)), address=address, detail=detail)
+    for i, entry in enumerate(address):
+        d = None
+        if type(detail) is list and i < len(detail):
+            d = str(detail[i])
+        if type(entry) is dict:
+            d = entry.get('detail', d)
+            entry = entry.get('address')
+        if entry is None:
+            module.fail_json(msg='alias address entry missing address', entry=entry)
+        entry = str(entry).strip()
+        # address is space separated & detail || separated in the config, quoting is no concern
+        if check and len(entry.split()) != 1:
+            module.fail_json(msg='invalid data in parameter: address', entry=entry)
+        if check and d is not None and '||' in d:
+            module.fail_json(msg='invalid data in parameter: detail', entry=entry)
+        entries[entry] = d
+    return entries
+
+
+def alias_config(module, params, aliases, index, changes):
+    # Add the changes for one alias to the change set, returns (diff, counts, alias)
+    # where alias is what the PHP leaves in $config, None if it's removed.
+    # Addresses are compared as a set, each paired with its detail, so only the
+    # entries added or removed are sent and the alias isn't touched if nothing moved.
+
+    args = ['name','descr','type']
+    diff = False
+    counts = dict(added=0, removed=0, detail=0)
+    item = dict(aliases[index]) if index != '' else dict()
+
+    base = ('aliases', 'alias', index)
+    if params['state'] == 'present':
+        wanted = alias_entries(module, params['address'], params['detail'])
+        fields = dict()
+        for p in args:
+            if isstr(params[p]) and (index=='' or aliases[index].get(p,'') != params[p]):
+                fields[p] = params[p]
+        item.update(fields)
+        if index=='':
+            if params['address'] is not None:
+                item['address'] = " ".join(wanted)
+                if any(d for d in wanted.values()):
+                    item['detail'] = "||".join(d or '' for d in wanted.values())
+                counts['added'] = len(wanted)
+            changes.append(base[:-1], item)
+            diff = True
+        else:
+            configuration = ""
+            if fields:
+                diff = True
+            if params['address'] is not None:
+                current = alias_entries(module, aliases[index].get('address',''), aliases[index].get('detail'), False)
+                removed = [a for a in current if a not in wanted]
+                changed = [(a, d) for a, d in wanted.items() if a not in current or (d is not None and d != (current[a] or ''))]
+                counts['removed'] = len(removed)
+                counts['added'] = len([a for a, d in changed if a not in current])
+                counts['detail'] = len(changed) - counts['added']
+                if removed or changed:
+                    # rebuild address & detail on the firewall from the existing pairs plus the delta
+                    if fields:
+                        configuration += php_merge(php_path(*base), fields)
+                    configuration += "$a = &" + php_path(*base) + ";\n"
+                    configuration += "$pairs = [];\n"
+                    configuration += "$det = isset($a['detail']) ? explode('||', $a['detail']) : [];\n"
+                    configuration += "foreach (preg_split('/\\s+/', trim($a['address']), -1, PREG_SPLIT_NO_EMPTY) as $i => $x) $pairs[$x] = isset($det[$i]) ? $det[$i] : '';\n"
+                    if removed:
+                        configuration += "foreach (" + php_value(removed) + " as $x) unset($pairs[$x]);\n"
+                    if changed:
+                        configuration += "foreach (" + php_value(OrderedDict((a, d or '') for a, d in changed)) + " as $x => $d) $pairs[$x] = $d;\n"
+                    configuration += "$a['address'] = implode(' ', array_keys($pairs));\n"
+                    configuration += "if (isset($a['detail']) || implode('', $pairs) !== '') $a['detail'] = implode('||', $pairs);\n"
+                    configuration += "unset($a);\n"
+                    pairs = OrderedDict((a, d or '') for a, d in current.items())
+                    for a in removed:
+                        del pairs[a]
+                    for a, d in changed:
+                        pairs[a] = d or ''
+                    item['address'] = " ".join(pairs)
+                    if 'detail' in item or "".join(pairs.values()) != '':
+                        item['detail'] = "||".join(pairs.values())
+            if configuration:
+                changes.set(base, item, php=configuration)
+                diff = True
+            elif fields:
+                changes.update(base, fields)
+    elif params['state'] == 'absent':
+        if index != '':
+            changes.unset(base, reindex=True)
+            diff = True
+        item = None
+    else:
+        module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
+
+    return diff, counts, item
+
 
 def run_module():
 
-    module_args = dict(
-        state=dict(required=False, default='present', choices=['present', 'absent']),
-        name=dict(required=True),
-        address=dict(required=False),
-        descr=dict(required=False, default=''),
-        type=dict(required=True, choices=['host', 'network', 'port', 'url', 'url_ports', 'urltable', 'urltable_ports']),
-        detail=dict(required=False),
+    module_args = dict(alias_args,
+        name=dict(required=False),
+        type=dict(required=False, choices=alias_args['type']['choices']),
+        aliases=dict(required=False, type=list),  # bulk mode, a list of aliases as above
+        exclusive=dict(required=False, default='no', choices=['yes','no']),
+        verify=dict(required=False, default='no', choices=['yes','no']),
+        return_state=dict(required=False, default='item', choices=['none','item','section']),
     )
 
-    args = ['name','address','descr','type','detail']
-
     result = dict(
         changed=False,
     )
 
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[['name','aliases']],
+        mutually_exclusive=[['name','aliases']],
+        required_together=[['name','type']],
         supports_check_mode=True
     )
 
-    configuration = ""
+    changes = ChangeSet()
     params = module.params
     section = 'aliases'
 
-    pfsense_check(module)
+    # a single alias can't say which others to keep
+    if params['exclusive'] == 'yes' and params['aliases'] is None:
+        module.fail_json(msg='exclusive: yes needs the full list in aliases')
 
-    # get config and find our alias
-    cfg = read_config(module,section)
-    try:
-        index = search(cfg['alias'],'name',params['name'])
-    except:
-        configuration = "if (empty($config['aliases'])) $config['aliases'] = [];\n"
-        index = ''
+    todo = bulk_items(module, alias_args, 'aliases', lambda alias: alias['name'])
 
-    base = "$config['aliases']['alias'][" + str(index) + "]"
-    if params['state'] == 'present':
-        for p in args:
-            if isstr(params[p]):
-                validate(module,p,params[p])
-                if index=='':
-                    configuration += "$alias['"+p+"']='" + params[p] + "';\n"
-                elif not p in cfg['alias'][index] or cfg['alias'][index][p] != params[p]:
-                    configuration += base + "['"+p+"']='" + params[p] + "';\n"
-        if index=='':
-            configuration += base + "=$alias;\n"
-    elif params['state'] == 'absent':
-        if index != '':
-            configuration += "unset("+base+");\n"
-    else:
-        module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
+    pfsense_check(module)
 
+    # get config and index our aliases by name once for the whole list
+    cfg = read_config(module,section)
+    aliases = cfg['alias'] if type(cfg) is dict and 'alias' in cfg else []
+    names = Index(aliases,'name')
+
+    clock = timed('diff')
+    wanted = set(alias['name'] for alias in todo)
+    statuses = []
+    marks = ""
+    touched = []
+    for alias in todo:
+        index = names.find(('name',alias['name']))
+        changed, counts, item = alias_config(module, alias, aliases, index, changes)
+        if item is not None:
+            touched.append(item)
+        if changed:
+            # pfsense_apply can swap the contents of a host/network table in place,
+            # anything else needs the whole filter reloaded. descr & detail don't reach pf at all.
+            structural = index == '' or alias['state'] == 'absent' or aliases[index].get('type') != alias['type']
+            if structural or counts['added'] or counts['removed']:
+                reload = structural or alias['type'] not in ['host','network']
+                marks += mark_dirty('aliases', dict(name=alias['name'], reload=reload))
+        statuses.append(dict(name=alias['name'], state=alias['state'], changed=changed, **counts))
+
+    # exclusive: anything in the firewall that wasn't declared goes
+    if params['exclusive'] == 'yes':
+        for k, alias in (enumerate(aliases) if type(aliases) is list else aliases.items()):
+            if alias.get('name') not in wanted:
+                changes.unset(('aliases', 'alias', k), reindex=True)
+                marks += mark_dirty('aliases', dict(name=alias.get('name'), reload=True))
+                statuses.append(dict(name=alias.get('name'), state='absent', changed=True))
+    clock.stop()
+
+    configuration = changes.php()
     result['phpcode'] = configuration
+    changes_result(module, result, changes)
+    if params['aliases'] is not None:
+        result['alias_status'] = statuses
+    else:
+        for count in ['added','removed','detail']:
+            result[count] = statuses[0][count]
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
-        write_config(module,configuration)
+        write_config(module,configuration,post=marks)
         result['changed'] = True
 
-    result[section] = read_config(module,section)
+        cfg = changes.apply(dict(aliases=cfg if type(cfg) is dict else dict()))[section]
+        if params['verify'] == 'yes':
+            verify_config(module,section,cfg)
+
+    return_state(module, result, section, cfg, dict(alias=touched))
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
@@ -30,6 +30,7 @@ e.g.
         all
  or some of these
         interfaces
+        vip
         hostname
         hosts
         resolv
@@ -38,12 +39,29 @@ e.g.
         reload_dns
         snmp
         filter
+        aliases    (swaps changed host/network alias tables in place with pfctl,
+                    reloads the whole filter only if an alias was added, removed or changed type)
         hasync
         dnsmasq
         unbound
         restart_webgui
         frr
     required: true
+  only_dirty:
+    description:
+      - yes to run only those of the services whose config the other pfsense modules have changed
+        since they were last applied, e.g. services: all with only_dirty: yes after a play.
+        Nothing is run when nothing changed.
+    default: no
+  background:
+    description:
+      - yes to run the reconfigure as a job detached from the session with daemon(8), and return its id
+        in job at once instead of waiting for it. Can't be used inside a pfsense_commit transaction.
+    default: no
+  job:
+    description:
+      - id of a background job to report on instead of applying anything. The task fails if the job did.
+    required: false
 
 author:
     - David Beveridge (@bevhost)
@@ -67,27 +85,246 @@ EXAMPLES = '''
     services:
       - filter
 
+- name: Apply alias changes made by pfsense_aliases
+  pfsense_apply:
+    services:
+      - aliases
+
 - name: Bulk configure the whole box, based on new config
   pfsense_apply:
     services:
       - all
 
+- name: Reconfigure whatever the play changed, and nothing else
+  pfsense_apply:
+    services:
+      - all
+    only_dirty: yes
+
+- name: Start the reconfigure and move on
+  pfsense_apply:
+    services:
+      - all
+    background: yes
+  register: apply
+
+- name: Later, wait for it to finish
+  pfsense_apply:
+    job: "{{ apply.job }}"
+  register: applied
+  until: applied.state == 'done'
+  retries: 60
+  delay: 5
+
 '''
 
 RETURN = '''
+job:
+    description: id of the background job started, or polled
+state:
+    description: when polling, running, done or failed
+current:
+    description: when polling a running job, the service it's on
+services:
+    description: when polling, list of service & seconds for each service the job has finished
+seconds:
+    description: when polling a finished job, how long it took altogether
+error:
+    description: when polling a failed job, why
+dirty:
+    description: services the modules had left to reconfigure, before this run
+tables:
+    description: alias tables whose contents were replaced with pfctl instead of a filter reload
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, pfsense_check
+from ansible.module_utils.pfsense import write_config, read_config, Index, pfsense_check, read_dirty, clear_dirty, dirty_file, \
+    transaction_active, php_string, php_value, state_dir, add_timings, timed
+import json
 import os
+import re
+import tempfile
+import time
+
+pfctl = "/sbin/pfctl"
+daemon = "/usr/sbin/daemon"
+php_cli = "/usr/local/bin/php"
+jobs_dir = os.path.join(state_dir, 'jobs')
+job_timeout = 60    # seconds a job may take to get a pid before it's given up on
+
+# the services in the order they are applied, each also the name of its dirty mark
+services_order = ['interfaces', 'vip', 'hostname', 'hosts', 'resolv', 'timezone', 'ntp', 'reload_dns', 'snmp',
+                  'filter', 'aliases', 'hasync', 'dnsmasq', 'unbound', 'restart_webgui', 'frr']
+
+# plain addresses & networks can go straight into a pf table,
+# hostnames, ranges & nested aliases need pfSense to expand them on a filter reload
+table_entry = re.compile(r'^([0-9]{1,3}(\.[0-9]{1,3}){3}|[0-9a-fA-F]*:[0-9a-fA-F:.]*)(/[0-9]{1,3})?$')
+
+
+def pfctl_replace(module, table, addresses):
+    # Swap the contents of one pf table, False if pfctl wouldn't
+    fd, name = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write("\n".join(addresses) + "\n")
+        rc, out, err = module.run_command([pfctl, '-t', table, '-T', 'replace', '-f', name])
+    finally:
+        os.remove(name)
+    return rc == 0
+
+
+def alias_tables(module):
+    # Work out the tables pfsense_aliases left to update, None if only a filter reload will do
+    marks = read_dirty('aliases')
+    if any(mark.get('reload') for mark in marks):
+        return None
+
+    cfg = read_config(module,'aliases')
+    try:
+        aliases = cfg['alias']
+    except (KeyError, TypeError):
+        aliases = []
+    index = Index(aliases,'name')
+
+    tables = []
+    names = sorted(set(mark.get('name') for mark in marks))
+    for name in names:
+        k = index.find(('name',name))
+        if k == '' or aliases[k].get('type') not in ['host','network']:
+            return None
+        addresses = aliases[k].get('address','').split()
+        if not all(table_entry.match(a) for a in addresses):
+            return None
+        tables.append((name, addresses))
+
+    # pfSense copies a nested alias's addresses into the tables of the aliases that list it
+    for alias in aliases:
+        if isinstance(alias, dict) and set(str(alias.get('address','')).split()) & set(names):
+            return None
+    return tables
+
+
+def job_file(job, ext):
+    return os.path.join(jobs_dir, job + ext)
+
+
+def job_php(job, steps, clean):
+    # A PHP script running the steps on its own, noting in the job's status file
+    # which service it's on and how long each took
+    php = "<?php\n"
+    php += "require_once('globals.inc');\nrequire_once('functions.inc');\nrequire_once('config.inc');\n"
+    php += "require_once('util.inc');\nrequire_once('interfaces.inc');\nrequire_once('system.inc');\n"
+    php += "require_once('services.inc');\nrequire_once('filter.inc');\n"
+    php += "$status = ['job' => " + php_string(job) + ", 'state' => 'running', 'pid' => getmypid(), 'started' => microtime(true), 'services' => []];\n"
+    php += "$save = function() use (&$status) {\n"
+    php += "    file_put_contents(" + php_string(job_file(job, '.json.tmp')) + ", json_encode($status));\n"
+    php += "    rename(" + php_string(job_file(job, '.json.tmp')) + ", " + php_string(job_file(job, '.json')) + ");\n"
+    php += "};\n"
+    php += "register_shutdown_function(function() use (&$status, $save) {\n"
+    php += "    if ($status['state'] != 'running') return;\n"
+    php += "    $e = error_get_last();\n"
+    php += "    $status['state'] = 'failed';\n"
+    php += "    $status['error'] = $e ? $e['message'] : 'exited early';\n"
+    php += "    $status['finished'] = microtime(true);\n"
+    php += "    $save();\n"
+    php += "});\n"
+    php += "$save();\n"
+    # the marks are taken before the first step runs, one left by a task meanwhile is kept for the next apply
+    php += "foreach (" + php_value([dirty_file(s) for s in clean]) + " as $f) @unlink($f);\n"
+    for service, code in steps:
+        php += "$status['current'] = " + php_string(service) + ";\n$save();\n$t = microtime(true);\n"
+        php += code
+        php += "$status['services'][] = ['service' => " + php_string(service) + ", 'seconds' => round(microtime(true) - $t, 3)];\n"
+    php += "unset($status['current']);\n$status['state'] = 'done';\n$status['finished'] = microtime(true);\n$save();\n"
+    return php
+
+
+def job_start(module, steps, clean):
+    # Run the steps in a PHP process daemon(8) detaches from this session, returns its job id.
+    # The status file is there from the start, daemon(8) leaves the pid for job_result() to check.
+    job = time.strftime('%Y%m%d%H%M%S') + '-' + str(os.getpid())
+    try:
+        if not os.path.isdir(jobs_dir):
+            os.makedirs(jobs_dir, 0o700)
+        # jobs older than a day are of no more interest
+        for name in os.listdir(jobs_dir):
+            if os.path.getmtime(os.path.join(jobs_dir, name)) < time.time() - 86400:
+                os.remove(os.path.join(jobs_dir, name))
+        fd = os.open(job_file(job, '.php'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(job_php(job, steps, clean))
+        fd = os.open(job_file(job, '.json'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(job=job, state='running', started=time.time(), services=[]), f)
+    except (IOError, OSError) as e:
+        module.fail_json(msg='error writing job '+job, error=str(e))
+    rc, out, err = module.run_command([daemon, '-f', '-p', job_file(job, '.pid'), php_cli, '-f', job_file(job, '.php')])
+    if rc != 0:
+        module.fail_json(msg='error starting job '+job, rc=rc, error=err)
+    return job
+
+
+def job_status(job):
+    # what the job's status file says, None if it can't be read
+    try:
+        with open(job_file(job, '.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def job_pid(job, status):
+    # the job's PHP process, from its own status or the pid file daemon(8) wrote, None if neither has it yet
+    if status.get('pid'):
+        return status['pid']
+    try:
+        with open(job_file(job, '.pid')) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def job_result(module, result, job):
+    # Exit with the status of a background job: state running, done or failed,
+    # the service it's on and the seconds each one took
+    if not re.match(r'^[0-9]+-[0-9]+$', job):
+        module.fail_json(msg='no such job: '+job)
+    status = job_status(job)
+    if status is None:
+        if not os.path.isfile(job_file(job, '.php')):
+            module.fail_json(msg='no such job: '+job)
+        # the status file is being replaced, or never got written
+        status = dict(job=job, state='running', started=os.path.getmtime(job_file(job, '.php')), services=[])
+    if status['state'] == 'running':
+        pid = job_pid(job, status)
+        gone = pid is None and time.time() - status.get('started', 0) > job_timeout
+        if pid is not None:
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                gone = True
+        if gone:
+            # it may have finished since the status was read
+            status = job_status(job) or status
+            if status['state'] == 'running':
+                status.update(state='failed', error='job is gone' if pid is not None else 'job never started')
+    if 'finished' in status:
+        status['seconds'] = round(status['finished'] - status['started'], 3)
+    result.update(status)
+    if status['state'] == 'failed':
+        module.fail_json(msg='job '+job+' failed', **result)
+    module.exit_json(**add_timings(result))
 
 
 def run_module():
 
     module_args = dict(
-        services=dict(required=True, default=None),
+        services=dict(required=False, default=None),
+        only_dirty=dict(required=False, default='no', choices=['yes','no']),
+        background=dict(required=False, default='no', choices=['yes','no']),
+        job=dict(required=False),
     )
 
     result = dict(
@@ -96,88 +333,141 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[['services','job']],
+        mutually_exclusive=[['services','job']],
         supports_check_mode=True
     )
 
     params = module.params
     services = params['services']
 
-    configuration = ""
+    steps = []      # (service, php) in the order they run
 
     pfsense_check(module)
 
-    cfg = read_config(module);
+    if params['job'] is not None:
+        job_result(module, result, params['job'])
 
+    clock = timed('diff')
     if 'all' in services:
         DoAll = True
     else:
         DoAll = False
 
+    # the subsystems modules have marked since the last apply
+    dirty = [s for s in services_order if read_dirty(s)]
+    result['dirty'] = dirty
+    if params['only_dirty'] == 'yes':
+        services = [s for s in dirty if s in services or DoAll]
+        DoAll = False
+
+    reload_filter = 'filter' in services or DoAll
+    tables = []
+    if 'aliases' in services and not reload_filter:
+        tables = alias_tables(module)
+        # pf must not see aliases that aren't committed yet, the reload waits for the commit
+        if tables is None or (tables and transaction_active()):
+            reload_filter = True
+            tables = []
+
     if 'interfaces' in services or DoAll:
-        configuration += "interfaces_configure();\n"
+        steps.append(('interfaces', "interfaces_configure();\n"))
+
+    if 'vip' in services or DoAll:
+        steps.append(('vip', "interfaces_vips_configure();\n"))
    
     if 'hostname' in services or DoAll:
-        configuration += "system_hostname_configure();\n"
+        steps.append(('hostname', "system_hostname_configure();\n"))
 
     if 'hosts' in services or DoAll:
-        configuration += "system_hosts_generate();\n"
+        steps.append(('hosts', "system_hosts_generate();\n"))
    
     if 'resolv' in services or DoAll:
-        configuration += "system_resolvconf_generate();\n"
+        steps.append(('resolv', "system_resolvconf_generate();\n"))
    
     if 'timezone' in services or DoAll:
-        configuration += "system_timezone_configure();\n"
+        steps.append(('timezone', "system_timezone_configure();\n"))
    
     if 'ntp' in services or DoAll:
-        configuration += "system_ntp_configure();\n"
+        steps.append(('ntp', "system_ntp_configure();\n"))
    
     if 'reload_dns' in services or DoAll:
-        configuration += "send_event('service reload dns');\n"
+        steps.append(('reload_dns', "send_event('service reload dns');\n"))
    
     if 'snmp' in services or DoAll:
-        configuration += "services_snmpd_configure();\n"
+        steps.append(('snmp', "services_snmpd_configure();\n"))
     
-    if 'filter' in services or DoAll:
-        configuration += "require_once('filter.inc');filter_configure();clear_subsystem_dirty('filter');\n"
+    if reload_filter:
+        steps.append(('filter', "require_once('filter.inc');filter_configure();clear_subsystem_dirty('filter');\n"))
 
     if 'hasync' in services or DoAll:
-        configuration += "interfaces_sync_setup();\n"
+        steps.append(('hasync', "interfaces_sync_setup();\n"))
 
+    # the enable flags are checked by PHP as it applies, rather than reading the sections first
     if 'dnsmasq' in services or DoAll:
-        try: 
-            if cfg['dnsmasq']['enable']:
-                configuration += "services_dnsmasq_configure();\n" 
-        except:
-            pass
+        steps.append(('dnsmasq', "if (isset($config['dnsmasq']['enable'])) services_dnsmasq_configure();\n"))
 
     if 'unbound' in services or DoAll:
-        try: 
-            if cfg['unbound']['enable']:
-                configuration += "services_unbound_configure();\n" 
-        except:
-            pass
+        steps.append(('unbound', "if (isset($config['unbound']['enable'])) services_unbound_configure();\n"))
    
     if 'restart_webgui' in services or DoAll:
-        configuration += "system_webgui_start();\n"
+        steps.append(('restart_webgui', "system_webgui_start();\n"))
 
   #  if '' in services or DoAll:
-  #      configuration += 
+  #      steps.append(('', ...))
    
     if 'frr' in services or DoAll:
         if os.path.isfile('/usr/local/pkg/frr.inc'):   # Check frr installed.
-            configuration += "include('/usr/local/pkg/frr.inc');frr_generate_config();\n"
+            steps.append(('frr', "include('/usr/local/pkg/frr.inc');frr_generate_config();\n"))
+    clock.stop()
 
-    result['phpcode'] = configuration
+    result['phpcode'] = "".join(php for service, php in steps)
+    result['tables'] = [name for name, addresses in tables]
 
-    if module.check_mode:
-        module.exit_json(**result)
+    if params['background'] == 'yes' and transaction_active():
+        module.fail_json(msg='background apply has to wait for the commit, run it after pfsense_commit')
 
-    if configuration != '':
-        write_config(module,configuration)
+    if module.check_mode:
+        module.exit_json(**add_timings(result))
+
+    clock = timed('pfctl')
+    for name, addresses in tables:
+        if pfctl_replace(module, name, addresses):
+            result['changed'] = True
+        elif not reload_filter:
+            # pfctl refused, fall back to reloading everything
+            reload_filter = True
+            steps.append(('filter', "require_once('filter.inc');filter_configure();clear_subsystem_dirty('filter');\n"))
+            result['phpcode'] = "".join(php for service, php in steps)
+    clock.stop()
+
+    # what ran is clean again, a filter reload takes the aliases along
+    clean = [s for s in services_order if (s in services or DoAll) and s not in ['filter', 'aliases']]
+    if reload_filter:
+        clean.append('filter')
+    if reload_filter or tables:
+        clean.append('aliases')
+
+    if steps and params['background'] == 'yes':
+        # the job clears the marks itself as it starts
+        result['job'] = job_start(module, steps, clean)
+        result['changed'] = True
+        module.exit_json(**add_timings(result))
+
+    # reconfigure after the write, so inside a transaction it waits for the commit
+    if steps:
+        post = result['phpcode']
+        if transaction_active():
+            # and the marks are only cleared once the commit has run the steps
+            post += "foreach (" + php_value([dirty_file(s) for s in clean]) + " as $f) @unlink($f);\n"
+            clean = []
+        write_config(module,'',post=post)
         result['changed'] = True
 
+    for s in clean:
+        clear_dirty(s)
  
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
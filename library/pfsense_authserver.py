@@ -41,6 +41,14 @@ options:
   radius_*:
     description: RADIUS Parameters
     required: when type above is radius
+  verify:
+    description: check the authservers written against the firewall's copy, rather than trust the computed result
+    default: no
+    required: false
+  return_state:
+    description: item returns just this server, section all authservers, none leaves them out of the result
+    default: item
+    required: false
 
 author:
     - David Beveridge (@bevhost)
@@ -85,13 +93,15 @@ EXAMPLES = '''
 
 RETURN = '''
 authserver:
-    description: dict containing data structure for all auth servers
+    description: list holding this auth server, or with return_state=section all auth servers
+changes:
+    description: with --diff, the changes made to the system section as a list of op, path & value
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, search, pfsense_check, validate
+from ansible.module_utils.pfsense import write_config, read_config, verify_config, return_state, search, pfsense_check, isstr, add_timings, timed, ChangeSet, changes_result
 
 
 def run_module():
@@ -126,7 +136,9 @@ def run_module():
         ldap_attr_groupobj=dict(required=False, default="group"),
         ldap_timeout=dict(required=False, default="25"),
         ldap_binddn=dict(required=False),
-        ldap_bindpw=dict(required=False)
+        ldap_bindpw=dict(required=False),
+        verify=dict(required=False, default='no', choices=['yes','no']),
+        return_state=dict(required=False, default='item', choices=['none','item','section'])
     )
 
     result = dict(
@@ -140,59 +152,63 @@ def run_module():
 
     params = module.params
 
-    configuration = ""
+    changes = ChangeSet()
 
     pfsense_check(module)
 
     # get config and find our authserver
     cfg = read_config(module,'system')
     try:
-        index = search(cfg['authserver'],'refid',params['refid'])
+        servers = cfg['authserver']
+        index = search(servers,'refid',params['refid'])
     except:
+        servers = []
         index = ''
-        configuration = "$config['system']['authserver']=[];\n"
+    server = dict() if index=='' else dict(servers[index])
 
-    base = "$config['system']['authserver'][" + str(index) + "]"
+    clock = timed('diff')
+    base = ('system', 'authserver', index)
 
     if params['state'] == 'present':
 
-        for p in ['type','refid','name','host']:
-            validate(module,p,params[p])
-            if index=='':
-                configuration += "$auth['" + p + "'] = '" + params[p] + "';\n"
-            elif params[p] != cfg['authserver'][index][p]:
-                configuration += base + "['" + p + "'] = '" + params[p] + "';\n"
-
-        for p in params:
-            if type(params[p]) is str and p.split('_')[0]==params['type']:
-                validate(module,p,params[p])
-                if index=='':
-                    configuration += "$auth['" + p + "'] = '" + params[p] + "';\n"
-                elif  params[p] != cfg['authserver'][index][p]:
-                    configuration += base + "['" + p + "'] = '" + params[p] + "';\n"
+        # the common fields, then those for this type of server (ldap_* or radius_*)
+        fields = ['type','refid','name','host'] + [p for p in params if isstr(params[p]) and p.split('_')[0]==params['type']]
+        updates = dict()
+        for p in fields:
+            if index=='' or params[p] != servers[index].get(p):
+                updates[p] = params[p]
+        server.update(updates)
         if index=='':
-            configuration += base + "=$auth;\n"
+            changes.append(base[:-1], server)
+        elif updates:
+            changes.update(base, updates)
 
     elif params['state'] == 'absent':
         if index != '':
-            configuration += "unset("+base+");\n"
+            changes.unset(base, reindex=True)
+        server = None
     else:
         module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
+    clock.stop()
 
-
+    configuration = changes.php()
     result['phpcode'] = configuration
+    changes_result(module, result, changes)
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
         write_config(module,configuration)
         result['changed'] = True
 
-    cfg = read_config(module,'system')
-    result['authserver'] = cfg['authserver']
+        servers = changes.apply(dict(system=cfg if type(cfg) is dict else dict()))['system']['authserver']
+        if params['verify'] == 'yes':
+            verify_config(module,'system/authserver',servers)
+
+    return_state(module, result, 'authserver', servers, [server] if server is not None else [])
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
@@ -18,6 +18,10 @@ short_description: Load SSL Cert & Key
 
 description:
   - Loads SSL Certificate into the configuration. can be used for WebGui, or Load balancers and other services.
+  - Certificates on the firewall are compared by SHA-256 fingerprints of crt & prv worked out on each side,
+    so a cert & key are only sent to the firewall when they differ from what it has.
+  - Given a list in 'certs', CAs, intermediates & certs are read once, matched by refid and all changes
+    written with a single write_config().
 
 version_added: "2.7"
 
@@ -29,15 +33,33 @@ options:
   descr:
     description:
       - Description Name of the certifcate to identify it in the GUI
-     required: true
+    required: true, to add a cert
   crt:
     description:
       - base64 encoded public certificate with any intermediates follwoing on in the file
-    required: true
+    required: true, to add a cert
   prv:
     description:
-      - base64 encoded private key 
-    required: true
+      - base64 encoded private key, CAs may go without
+    required: false
+  type:
+    description:
+      - server or user for a cert, ca for a CA or intermediate, which goes in the ca section
+    default: server
+  caref:
+    description:
+      - refid of the CA that signed this one
+    required: false
+  certs:
+    description:
+      - bulk mode, a list of certs & CAs each with the options above, instead of refid etc.
+    required: false
+  return_state:
+    description:
+      - item returns just this cert, section all certs, none leaves them out of the result.
+        The crt & prv bodies are never returned, nor shown in phpcode.
+    default: item
+    required: false
 
 author:
     - David Beveridge (@bevhost)
@@ -69,31 +91,109 @@ tasks:
       descr: "{{ cert['descr'] }}"
       crt: "{{ cert['public'] }}"
       prv: "{{ cert['private'] }}"
+
+  - name: Load the CAs & certs in one go
+    pfsense_cert:
+      certs:
+        - refid: 5c0ca0000001
+          type: ca
+          descr: "Example Root CA"
+          crt: "{{ lookup('file', 'ca.crt') | b64encode }}"
+        - refid: 5c0ca0000002
+          type: ca
+          descr: "Example Intermediate CA"
+          crt: "{{ lookup('file', 'intermediate.crt') | b64encode }}"
+          caref: 5c0ca0000001
+        - refid: "{{ cert['public'] | hash('sha1') }}"
+          descr: "{{ cert['descr'] }}"
+          crt: "{{ cert['public'] }}"
+          prv: "{{ cert['private'] }}"
+          caref: 5c0ca0000002
 '''
 
 RETURN = '''
-section:
-    description: dict containing data structure for that section
+cert:
+    description: list holding this cert, or with return_state=section all certs, without crt & prv
+ca:
+    description: the same for CAs, when the task has any
+certs:
+    description: in bulk mode, list of refid, type, state & changed for each cert
 debug:
     description: Any debug messages for unexpected input types
     type: str
+changes:
+    description: with --diff, the changes made to the cert section as a list of op, path & value, crt & prv as '<changed>'
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, search, pfsense_check, validate, isstr
+from ansible.module_utils.pfsense import write_config, read_fingerprints, fingerprint, return_state, Index, pfsense_check, isstr, bulk_items, add_timings, timed, mark_dirty, php_value, ChangeSet, changes_result
+
+
+cert_args = dict(
+    state=dict(required=False, default='present', choices=['present', 'absent']),
+    type=dict(required=False, default='server', choices=['server', 'user', 'ca']),
+    refid=dict(required=True),  # 13 hex digit
+    crt=dict(required=False),
+    prv=dict(required=False, no_log=True),
+    descr=dict(required=False),
+    caref=dict(required=False),
+)
+
+
+def cert_config(module, params, certs, index, changes, shown):
+    # Add the changes for one cert or CA to the change sets, returns (diff, cert)
+    # where cert is what the PHP leaves in $config, None if it's removed.
+    # certs holds fingerprints for crt & prv, so the bodies are only sent when they differ.
+
+    diff = False
+    section = 'ca' if params['type'] == 'ca' else 'cert'
+    base = (section, index)
+    cert = dict() if index=='' else dict(certs[index])
+
+    if params['state'] == 'present':
+        if index=='' and not (isstr(params['crt']) and isstr(params['descr'])):
+            module.fail_json(msg='crt & descr are needed to add '+section+' '+params['refid'])
+        fields = dict()
+        for p in ['refid','descr','caref']:
+            if isstr(params[p]) and (index=='' or certs[index].get(p) != params[p]):
+                fields[p] = params[p]
+        if index=='' and section == 'cert':
+            fields['type'] = params['type']
+        for p in ['crt','prv']:
+            if isstr(params[p]) and (index=='' or certs[index].get(p) != fingerprint(params[p])):
+                fields[p] = params[p]
+        cert.update(fields)
+        # phpcode shows the same PHP, less the cert & key bodies
+        masked = dict((p, '...' if p in ['crt','prv'] else v) for p, v in fields.items())
+        if index=='':
+            changes.append(base[:-1], cert)
+            shown.append(base[:-1], masked)
+        elif fields:
+            changes.update(base, fields)
+            shown.update(base, masked)
+        diff = bool(fields)
+    elif params['state'] == 'absent':
+        if index != '':
+            changes.unset(base, reindex=True)
+            shown.unset(base, reindex=True)
+            diff = True
+        cert = None
+    else:
+        module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
+
+    return diff, cert
 
 
 def run_module():
 
-    module_args = dict(
-        state=dict(required=False, default='present', choices=['present', 'absent']),
-        type=dict(required=False, default='server'),
-        refid=dict(required=True),  # 13 hex digit
-        crt=dict(required=True),
-        prv=dict(required=True),
-        descr=dict(required=True)
+    module_args = dict(cert_args,
+        refid=dict(required=False),
+        # bulk mode, a list of certs & CAs as above. no_log on the list would mask
+        # refids, descr & type everywhere in the result, only prv needs hiding
+        certs=dict(required=False, type='list', elements='dict', options=cert_args),
+        return_state=dict(required=False, default='item', choices=['none','item','section'])
     )
 
     result = dict(
@@ -102,56 +202,68 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[['refid','certs']],
+        mutually_exclusive=[['refid','certs']],
         supports_check_mode=True
     )
 
-    configuration = ""
+    changes = ChangeSet()
+    shown = ChangeSet()     # the changes as reported back, without the cert & key bodies
     params = module.params
 
-    pfsense_check(module)
-
-    # get config and find our cert
-    cfg = read_config(module,'cert')
-    index = search(cfg,'refid',params['refid'])
+    todo = bulk_items(module, cert_args, 'certs', lambda item: ('ca' if item['type'] == 'ca' else 'cert', item['refid']))
+    sections = sorted(set('ca' if item['type'] == 'ca' else 'cert' for item in todo))
 
-    base = "$config['cert'][" + str(index) + "]"
-    if params['state'] == 'present':
-        for p in ['refid','descr','crt','prv']:
-            if isstr(params[p]):
-                validate(module,p,params[p])
-                if index=='':
-                    configuration += "$cert['"+p+"']='" + params[p] + "';\n"
-                elif cfg[index][p] != params[p]:
-                    configuration += base + "['"+p+"']='" + params[p] + "';\n"
-        if index=='':
-            configuration += base + "=$cert;\n"
-    elif params['state'] == 'absent':
-        if index != '':
-            configuration += "unset("+base+");\n"
-    else:
-        module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
+    pfsense_check(module)
 
-    result['phpcode'] = configuration
+    # get the sections with fingerprints in place of the bodies, and index them by refid once
+    cfg = read_fingerprints(module, sections)
+    for s in sections:
+        if type(cfg[s]) is not list:
+            cfg[s] = []
+    refids = dict((s, Index(cfg[s],'refid')) for s in sections)
+
+    clock = timed('diff')
+    statuses = []
+    touched = dict((s, []) for s in sections)
+    written = []
+    for item in todo:
+        section = 'ca' if item['type'] == 'ca' else 'cert'
+        index = refids[section].find(('refid',item['refid']))
+        changed, cert = cert_config(module, item, cfg[section], index, changes, shown)
+        if cert is not None:
+            touched[section].append(cert)
+        if changed:
+            written.append(item['refid'])
+        statuses.append(dict(refid=item['refid'], type=item['type'], state=item['state'], changed=changed))
+    clock.stop()
+
+    configuration = changes.php()
+    result['phpcode'] = shown.php()
+    if params['certs'] is not None:
+        result['certs'] = statuses
+    changes_result(module, result, changes)
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
-        write_config(module,configuration)
+        # the webgui only needs a restart if one of these is its cert
+        post = "if (isset($config['system']['webgui']['ssl-certref']) && in_array($config['system']['webgui']['ssl-certref'], " + \
+            php_value(written) + ", true)) {\n" + mark_dirty('restart_webgui') + "}\n"
+        write_config(module,configuration,post=post)
         result['changed'] = True
 
-    for section in params:
-        if type(params[section]) is dict:
-            result[section] = read_config(module,section)
+        cfg = changes.apply(cfg)
+
+    # crt & prv are never returned
+    for s in sections:
+        return_state(module, result, s, cfg[s], touched[s])
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
 
 if __name__ == '__main__':
     main()
-
-
-
-
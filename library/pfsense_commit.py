@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# vim: set expandtab:
+
+# Copyright: (c) 2018, David Beveridge <dave@bevhost.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: pfsense_commit
+
+short_description: Groups the changes of many tasks into a single write_config()
+
+description:
+  - Every write_config() makes pfSense rewrite config.xml, save a backup revision and,
+    with High Availability Sync on, push the config to the peer.
+  - state=begin starts a transaction. Until it is committed, the other pfsense modules
+    queue their changes on the firewall instead of writing them. Their reads still see
+    the queued changes.
+  - The queue belongs to the run that began it. Export the returned transaction id as
+    PFSENSE_TRANSACTION to the other tasks (see the example) and a module finding any other
+    queue fails, rather than queueing onto it. Without it, a queue unused for longer than
+    timeout is taken for one left behind by a failed run.
+  - state=commit replays the whole queue in one PHP session with one write_config(),
+    then runs anything the modules wanted done after the write.
+  - state=abort throws the queue away, whichever run it belongs to.
+  - Run pfsense_apply after the commit, so it sees the committed config.
+
+version_added: "2.7"
+
+options:
+  state:
+    description: begin, commit or abort
+    required: true
+  timeout:
+    description: seconds a transaction may go unused before the modules refuse its queue
+    required: false
+    default: 3600
+
+author:
+    - David Beveridge (@bevhost)
+
+notes:
+Ansible is located in an different place on BSD systems such as pfsense.
+You can create a symlink to the usual location like this
+
+ansible -m raw -a "/bin/ln -s /usr/local/bin/python2.7 /usr/bin/python" -k -u root mybsdhost1
+
+Alternatively, you could use an inventory variable
+
+[fpsense:vars]
+ansible_python_interpreter=/usr/local/bin/python2.7
+
+'''
+
+EXAMPLES = '''
+- hosts: firewalls
+  environment:
+    PFSENSE_TRANSACTION: "{{ txn.transaction | default('') }}"
+  tasks:
+    - pfsense_commit:
+        state: begin
+      register: txn
+
+    - pfsense_aliases:
+        aliases: "{{ fw_aliases }}"
+
+    - pfsense_filter_rules:
+        rules: "{{ fw_filter }}"
+
+    - pfsense_commit:
+        state: commit
+
+    - pfsense_apply:
+        services:
+          - all
+'''
+
+RETURN = '''
+queued:
+    description: number of queued writes committed or discarded
+transaction:
+    description: id of the transaction begun, committed or aborted
+phpcode:
+    description: Actual PHP Code sent to pfSense PHP Shell
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.pfsense import session, cache_clear, pfsense_check, \
+    state_dir, queue_file, snapshot_file, transaction_active, transaction_header, queued_config, add_timings
+import json
+import os
+import time
+
+
+def drop_snapshot():
+    # the config the reads replayed the queue into, see transaction_php()
+    try:
+        os.remove(snapshot_file)
+    except OSError:
+        pass
+
+
+def run_module():
+
+    module_args = dict(
+        state=dict(required=True, choices=['begin', 'commit', 'abort']),
+        timeout=dict(required=False, default=3600, type='int'),
+    )
+
+    result = dict(
+        changed=False,
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    params = module.params
+
+    # only a commit has to own the queue, begin & abort are how a stale one is got rid of
+    pfsense_check(module, transaction=params['state'] == 'commit')
+
+    queued = []
+    if transaction_active():
+        queued = queued_config(module)
+        result['transaction'] = transaction_header(module).get('transaction')
+    result['queued'] = len(queued)
+
+    if params['state'] == 'begin':
+        # a queue left behind by a failed play is discarded, queued tells how much
+        result['transaction'] = time.strftime('%Y%m%d%H%M%S') + '-' + str(os.getpid())
+        if module.check_mode:
+            module.exit_json(**add_timings(result))
+        try:
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir, 0o700)
+            drop_snapshot()
+            fd = os.open(queue_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(dict(transaction=result['transaction'], started=time.time(), timeout=params['timeout'])) + "\n")
+        except (IOError, OSError) as e:
+            module.fail_json(msg='error creating '+queue_file, error=str(e))
+        result['changed'] = True
+        module.exit_json(**add_timings(result))
+
+    if not transaction_active():
+        module.fail_json(msg='no transaction in progress, use state=begin first')
+
+    if params['state'] == 'abort':
+        if not module.check_mode:
+            os.remove(queue_file)
+            drop_snapshot()
+        result['changed'] = len(queued) > 0
+        module.exit_json(**add_timings(result))
+
+    configuration = "\n".join(q['php'] for q in queued)
+    post = "\n".join(q['post'] for q in queued)
+
+    result['phpcode'] = configuration
+
+    if module.check_mode:
+        module.exit_json(**add_timings(result))
+
+    # run the queue directly, write_config() would only queue it again.
+    # If it fails the queue stays put, to be retried or aborted.
+    if queued:
+        cache_clear()
+        session(module).run(configuration + '\nwrite_config();\n' + post, 'error writing config', 'write')
+        cache_clear()
+        result['changed'] = True
+    os.remove(queue_file)
+    drop_snapshot()
+
+    module.exit_json(**add_timings(result))
+
+def main():
+    run_module()
+
+if __name__ == '__main__':
+    main()
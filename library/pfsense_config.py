@@ -21,7 +21,9 @@ description:
     safe_mode (default) prevents the creation of new keys that do not already exist in the config.
     If safe mode is turned off, new keys can be created, if done incorrectly, could produce strange results.
     To determine what can be loaded, save a prefconfigured pfSense Firewall confuration xml file and convert it to yaml.
-  - CAN NOT be used to unset an option such as $config['system']['dnsallowoverride']);
+  - A key given as null (~) or false is removed, e.g. $config['system']['dnsallowoverride'], true sets an empty flag.
+  - Values are compared with the section on the firewall at any depth, and only the keys that differ are written.
+    Lists are compared in order.
 
 version_added: "2.7"
 
@@ -31,10 +33,17 @@ options:
     required: true
   value:
     description:
-      - string, simple list or dict values.
-        Must only be 1 level deep.
+      - string, list or dict values, nested to any depth.
         Must only be used for single items, use other modules for things that have multiple entries.
     required: true
+  verify:
+    description: check the section written against the firewall's copy, rather than trust the computed result
+    default: no
+    required: false
+  return_state:
+    description: item returns just the keys given, section the whole of each section, none neither
+    default: item
+    required: false
 
 author:
     - David Beveridge (@bevhost)
@@ -112,20 +121,143 @@ EXAMPLES = '''
     nat:
       outbound:
         mode: hybrid
+
+- name: Let DHCP override the DNS servers no more
+  pfsense_config:
+    system:
+      dnsallowoverride: ~
 '''
 
 RETURN = '''
 section:
-    description: dict containing data structure for that section
+    description: dict holding the keys given for that section, or with return_state=section all of it
 debug:
     description: Any debug messages for unexpected input types
     type: str
+changes:
+    description: with --diff, the changes made as a list of op, path & value
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, pfsense_check, validate, isstr
+from ansible.module_utils.pfsense import write_config, read_config, verify_config, return_state, pfsense_check, isstr, add_timings, timed, mark_dirty, ChangeSet, changes_result
+
+
+# what pfsense_apply has to reconfigure after a change to a section or key
+reconfigure = {
+    'system/hostname': ['hostname','hosts','resolv'],
+    'system/domain': ['hostname','hosts','resolv'],
+    'system/dnsserver': ['resolv','reload_dns'],
+    'system/dnsallowoverride': ['resolv'],
+    'system/timezone': ['timezone'],
+    'system/timeservers': ['ntp'],
+    'system/webgui': ['restart_webgui'],
+    'interfaces': ['interfaces','filter'],
+    'virtualip': ['vip'],
+    'filter': ['filter'],
+    'aliases': ['filter'],
+    'nat': ['filter'],
+    'snmpd': ['snmp'],
+    'ntpd': ['ntp'],
+    'hasync': ['hasync'],
+    'dnsmasq': ['dnsmasq'],
+    'unbound': ['unbound'],
+}
+
+
+def dirtied(changes):
+    # the subsystems a change set leaves dirty, section/key first then the section
+    subsystems = []
+    for change in changes.changes():
+        path = change['path'].split('/')
+        for s in reconfigure.get('/'.join(path[:2]), reconfigure.get(path[0], [])):
+            if s not in subsystems:
+                subsystems.append(s)
+    return subsystems
+
+
+# Arrays of Dict, each has a module of its own
+DoNotCreate = ['rule','cert','user','group','authserver','alias','item','monitor_type','gateway_item','package']
+
+
+def config_value(value):
+    # a value as it goes into $config: numbers as strings, true as an empty (set) flag,
+    # with null & false keys left out
+    if type(value) is bool:
+        return '' if value else None
+    if type(value) in [int, float]:
+        return str(value)
+    if type(value) is dict:
+        return dict((k, config_value(v)) for k, v in value.items() if config_value(v) is not None)
+    if type(value) is list:
+        return [config_value(v) for v in value]
+    return value
+
+
+def config_diff(module, changes, path, wanted, current, create):
+    # Add the fewest set & unset operations that turn current into wanted, at any depth.
+    # wanted is a dict of keys to set, a key of null or false is removed. Lists are compared
+    # in order, item by item when their lengths match, otherwise replaced whole.
+    # New keys are only allowed with create (safe_mode: no).
+    name = ":".join(str(p) for p in path)
+    for key, value in wanted.items():
+        if key in DoNotCreate:
+            module.fail_json(msg='Cannot create array type, try pfsense_'+key+' module')
+        value = config_value(value)
+        here = path + (key,)
+        exists = isinstance(current, dict) and key in current
+
+        if value is None:
+            if exists:
+                changes.unset(here)
+            continue
+
+        if not exists:
+            if not create:
+                if len(path) == 1:
+                    module.fail_json(msg='Key: '+key+' not found in section: '+name+'. Cannot create new keys in safe mode')
+                module.fail_json(msg='SubKey: '+key+' not found in '+name+'. Cannot create new keys in safe mode')
+            changes.set(here, value)
+            continue
+
+        have = current[key]
+        if type(value) is dict:
+            # an empty element reads as '', it takes the whole dict
+            if have == '':
+                changes.set(here, value)
+            elif type(have) is not dict:
+                module.fail_json(msg=name + ":" + key + " requires " + str(type(have)))
+            else:
+                config_diff(module, changes, here, wanted[key], have, create)
+        elif type(value) is list:
+            if have == '':
+                changes.set(here, value)
+            elif type(have) is not list:
+                module.fail_json(msg=name + ":" + key + " requires " + str(type(have)))
+            elif len(have) != len(value):
+                changes.set(here, value)
+            else:
+                for i, v in enumerate(value):
+                    list_diff(module, changes, here + (i,), v, have[i], create)
+        elif isstr(value):
+            if type(have) in [dict, list]:
+                module.fail_json(msg=name + ":" + key + " requires " + str(type(have)))
+            if str(have) != value:
+                changes.set(here, value)
+        else:
+            module.fail_json(msg= name + ":" + key + " has unexpected type " + str(type(value)))
+
+
+def list_diff(module, changes, path, value, have, create):
+    # one item of a list, in the same way as config_diff() does a key
+    if type(value) is dict and type(have) is dict:
+        config_diff(module, changes, path, value, have, create)
+    elif type(value) is list and type(have) is list and len(value) == len(have):
+        for i, v in enumerate(value):
+            list_diff(module, changes, path + (i,), v, have[i], create)
+    elif value != have:
+        changes.set(path, value)
 
 
 def run_module():
@@ -139,6 +271,11 @@ def run_module():
         hasync=dict(type=dict),
         nat=dict(type=dict),
         installedpackages=dict(type=dict),
+        unbound=dict(type=dict),
+        dnsmasq=dict(type=dict),
+        ntpd=dict(type=dict),
+        verify=dict(required=False, default='no', choices=['yes','no']),
+        return_state=dict(required=False, default='item', choices=['none','item','section']),
     )
 
     result = dict(
@@ -152,101 +289,57 @@ def run_module():
 
     params = module.params
 
-    DoNotCreate = ['rule','cert','user','group','authserver','alias','item','monitor_type','gateway_item','package'];  # Arrays of Dict
     AllowCreateKeys = False
     if params['safe_mode'] == 'no':
         AllowCreateKeys = True
     del params['safe_mode']
+    verify = params.pop('verify')
 
-    configuration = ""
+    changes = ChangeSet()
 
     pfsense_check(module)
 
-    # Loop through all possible params
-    for section in params:
-
-        # Process provided sections 
-        if type(params[section]) is dict:
-
-            # Read existing configuration
-            result[section] = read_config(module,section)
-            if not type(result[section]) is dict:
-                result[section] = dict()
-
-            # Loop through provided keys in the section
-            for key in params[section]:
-
-                # Check for keys we can't handle here
-                if key in DoNotCreate:
-                    module.fail_json(msg='Cannot create array type, try pfsense_'+key+' module')
-
-                # Check that key exists in config (unless we are allowing key create "safe: no")
-                if (key in result[section]) or AllowCreateKeys:
-
-                    validate(module,section+":"+key,params[section][key])
-                    # String Type
-                    if isstr(params[section][key]):
-                        # Validate Data type provided matches existing config
-                        if (key in result[section]):
-                            if not isstr(result[section][key]):
-                                module.fail_json(msg=section + ":" + key + " requires " + str(type(result[section][key])))
-                        # Update if changed
-                        if not key in result[section] or str(result[section][key]) != params[section][key]:
-                            configuration += "$config['" + section + "']['" + key + "']='" + params[section][key] + "';\n"
-                            result[section][key] = params[section][key]
-
-                    # List Type
-                    elif type(params[section][key]) is list:
-                        # Validate Data type provided matches existing config
-                        if (key in result[section]):
-                            if type(result[section][key]) is not list:
-                                module.fail_json(msg=section + ":" + key + " requires " + str(type(result[section][key])))
-                        # Update if changed
-                        if set(result[section][key]) != set(params[section][key]):
-                            configuration += "$config['" + section + "']['" + key + "']=['"+"','".join(params[section][key])+"'];\n"
-                            result[section][key] = params[section][key]
-
-                    # Dict Type
-                    elif type(params[section][key]) is dict:
-                        # Validate Data type provided matches existing config
-                        if (key in result[section]):
-                            if type(result[section][key]) is not dict:
-                                module.fail_json(msg=section + ":" + key + " requires " + str(type(result[section][key])))
-                        # Loop thru subkeys k in dict
-                        for (k,v) in params[section][key].items():
-                            validate(module,section+":"+key+":"+k,v)
-                            if (k in result[section][key]) or AllowCreateKeys:
-                                # Type validation
-                                if (k in result[section][key]):
-                                    if not isstr(result[section][key][k]):
-                                        module.fail_json(msg="String expected in config at "+section + ":" + key + ":" + k + " " + str(type(result[section][key][k])) + " found")
-                                if type(v) is not str:
-                                    module.fail_json(msg="String value expected in "+section + ":" + key + ":" + k)
-                                # Update if changed
-                                if not k in  result[section][key] or result[section][key][k] != params[section][key][k]:
-                                    configuration += "$config['" + section + "']['" + key + "']['" + k + "'] = '" + v.replace("'","\\'") + "';\n"
-                                    result[section][key][k]=v
-                            else:
-                                module.fail_json(msg='SubKey: '+k+' not found in '+section+":"+key+'. Cannot create new keys in safe mode')
-                    else:
-                        module.fail_json(msg= section + ":" + key + " has unexpected type " + str(type(params[section][key])))
-                else:
-                    module.fail_json(msg='Key: '+key+' not found in section: '+section+'. Cannot create new keys in safe mode')
-
+    # Read existing configuration for all provided sections at once
+    sections = [section for section in params if type(params[section]) is dict]
+    if sections:
+        result.update(read_config(module,sections))
+
+    clock = timed('diff')
+    for section in sections:
+        if not type(result[section]) is dict:
+            result[section] = dict()
+            if AllowCreateKeys and config_value(params[section]):
+                # a missing or empty section ('' in $config) takes its keys in one go,
+                # once they've passed the same checks
+                config_diff(module, ChangeSet(), (section,), params[section], dict(), True)
+                changes.set((section,), config_value(params[section]))
+                continue
+        config_diff(module, changes, (section,), params[section], result[section], AllowCreateKeys)
+    clock.stop()
+
+    # each section as it will be once written
+    state = changes.apply(dict((section, result.pop(section)) for section in sections))
+    for section in sections:
+        keys = dict((key, state[section][key]) for key in params[section] if key in state[section])
+        return_state(module, result, section, state[section], keys)
+
+    configuration = changes.php()
     result['phpcode'] = configuration
+    changes_result(module, result, changes)
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
-        write_config(module,configuration)
+        write_config(module,configuration,post="".join(mark_dirty(s) for s in dirtied(changes)))
         result['changed'] = True
 
-    for section in params:
-        if type(params[section]) is dict:
-            result[section] = read_config(module,section)
+        # state already holds the sections as written, no need to read them back
+        if verify == 'yes':
+            for section in sections:
+                verify_config(module,section,state[section])
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
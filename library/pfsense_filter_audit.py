@@ -69,12 +69,14 @@ audit:
     description: dict containing list of rules from firewall not in our list
 trackers:
     description: list of trackers found in provided ruleset when none found in firewall config
+changes:
+    description: with --diff and enforce, the rules removed as an op, path & values
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell when enforce is yes
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, pfsense_check, isstr
+from ansible.module_utils.pfsense import write_config, read_config, pfsense_check, isstr, add_timings, timed, mark_dirty, ChangeSet, changes_result
 
 
 def run_module():
@@ -95,8 +97,9 @@ def run_module():
 
     count = 0
     audit = []
-    trackers = []
-    configuration = ""
+    strays = set()
+    trackers = set()
+    changes = ChangeSet()
     params = module.params
     enforce = params['enforce']
     rules = params['rules']
@@ -116,34 +119,47 @@ def run_module():
             state = 'present'
 
         if state == 'present':
-            trackers.append(str(rule['tracker']))
+            trackers.add(str(rule['tracker']))
 
     cfg = read_config(module,'filter')
-
-    for key,rule in enumerate(cfg['rule']):
-        tracker = rule['tracker']
+    try:
+        current = cfg['rule']
+    except (KeyError, TypeError):
+        current = []
+    if type(current) is dict:
+        current = list(current.values())
+
+    clock = timed('diff')
+    for rule in current:
+        tracker = str(rule.get('tracker',''))
         if tracker not in trackers:
             audit.append(rule)
-            if enforce == 'yes':
-                configuration += "unset($config['filter']['rule'][" + str(key) + "]);\n"
+            strays.add(tracker)
         else:
             count += 1
 
+    if enforce == 'yes' and strays:
+        # remove by tracker rather than position, so it still does the right thing
+        # if the rules moved since we read them, and reindex once at the end
+        changes.remove(('filter', 'rule'), 'tracker', strays)
+    clock.stop()
+
+    configuration = changes.php()
     result['audit'] = audit
     result['phpcode'] = configuration
+    changes_result(module, result, changes)
 
     if count == 0:
-        result['trackers'] = trackers
-        module.fail_json(msg='no matched rules: aborting')
+        module.fail_json(msg='no matched rules: aborting', trackers=sorted(trackers))
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
-        write_config(module,configuration)
+        write_config(module,configuration,post=mark_dirty('filter'))
         result['changed'] = True
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
@@ -23,6 +23,22 @@ See list and single useage examples below
 
 However, it could be used in singularly with a rule provided manually.
 
+Rules are compared in a canonical form, so a rerun of the same rules changes nothing:
+numbers and strings are alike (port 443 and '443'), port ranges may be given as 80:90 or 80-90,
+a floating rule's interfaces may come in any order, as a list or comma separated, any/not and
+the log, disabled, quick & floating flags may be '', yes/no or true/false, protocol any and an
+icmptype for anything but icmp are ignored and empty optional values are the same as none.
+Fields left out of a rule are left out of the rule written, e.g. a rule without log turns logging off,
+while a flag given without a value (log:) is on, like the empty element of an xml export.
+
+Given a list in 'rules', the filter section is read once, every rule is compared
+by tracker and all changes are written with a single write_config().
+
+filter_rules is returned as computed by the module rather than read back after the
+write. Set verify: yes to have the firewall's filter section checked against it.
+By default only the rules given to the task are returned, return_state: section
+returns the whole ruleset and return_state: none nothing at all.
+
 version_added: "2.7"
 
 
@@ -43,7 +59,14 @@ ansible_python_interpreter=/usr/local/bin/python2.7
 '''
 
 EXAMPLES = '''
-# example_firewall.yml playbook
+# example_firewall.yml playbook, the whole list in one task
+  vars_files:
+    - roles/example_firewall/vars/rules.yml
+  tasks:
+    - pfsense_filter_rules:
+        rules: "{{ fw_filter }}"
+
+# or one rule per task
   vars_files:
     - roles/example_firewall/vars/rules.yml
   tasks:
@@ -80,124 +103,252 @@ EXAMPLES = '''
 
 RETURN = '''
 filter_rules:
-    description: dict containing current filter rules
+    description: the rules this task declared as they now stand, or with return_state=section every rule in the filter
+rules:
+    description: in bulk mode, list of tracker, state, changed & updated for each rule
+updated:
+    description: fields that differed, for a single rule
 debug:
     description: Any debug messages for unexpected input types
     type: str
+changes:
+    description: with --diff, the changes made to the filter section as a list of op, path & value
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, search, pfsense_check, validate, isstr
-
-
-def run_module():
-
-    module_args = dict(
-        state=dict(required=False, default='present', choices=['present', 'absent']),
-        tracker=dict(required=True),  # 10 digit (e.g. timestamp)
-        type=dict(required=False, default='pass', choices=['pass', 'block', 'reject']),
-        disabled=dict(required=False),
-        quick=dict(required=False),
-        interface=dict(required=False, default='lan'),
-        ipprotocol=dict(required=False, default='inet', choices=['inet', 'inet6', 'inet46']),
-        icmptype=dict(required=False, default='any'),
-        protocol=dict(required=False, default=None, choices=['tcp', 'udp', 'tcp/udp', 'icmp', 'esp', 'ah', 'gre', 'ipv6', 'igmp', 'ospf', 'any', 'carp', 'pfsync', None]),
-        direction=dict(required=False, default='any', choices=['any','in','out']),
-        statetype=dict(required=False, default='keep state', choices=['keep state','sloppy state','synproxy state','none']),
-        floating=dict(required=False, choices=[None, True]),
-        source=dict(required=False, type=dict, default=dict(any='') ),
-        destination=dict(required=False, type=dict, default=dict(any='') ),
-        log=dict(required=False),
-        descr=dict(required=False)
-    )
-
-    result = dict(
-        changed=False,
-    )
-
-    module = AnsibleModule(
-        argument_spec=module_args,
-        supports_check_mode=True
-    )
-
-    params = module.params
+from ansible.module_utils.pfsense import write_config, read_config, verify_config, return_state, Index, pfsense_check, bulk_items, mark_dirty, ChangeSet, changes_result, add_timings, timed
+import re
+
+
+rule_args = dict(
+    state=dict(required=False, default='present', choices=['present', 'absent']),
+    tracker=dict(required=True),  # 10 digit (e.g. timestamp)
+    type=dict(required=False, default='pass', choices=['pass', 'block', 'reject']),
+    disabled=dict(required=False),
+    quick=dict(required=False),
+    interface=dict(required=False, default='lan', type='raw'),  # string or list, several for a floating rule
+    ipprotocol=dict(required=False, default='inet', choices=['inet', 'inet6', 'inet46']),
+    icmptype=dict(required=False, default='any'),
+    protocol=dict(required=False, default=None, choices=['tcp', 'udp', 'tcp/udp', 'icmp', 'esp', 'ah', 'gre', 'ipv6', 'igmp', 'ospf', 'any', 'carp', 'pfsync', None]),
+    direction=dict(required=False, default='any', choices=['any','in','out']),
+    statetype=dict(required=False, default='keep state', choices=['keep state','sloppy state','synproxy state','none']),
+    floating=dict(required=False, type='raw'),
+    source=dict(required=False, type=dict, default=dict(any='') ),
+    destination=dict(required=False, type=dict, default=dict(any='') ),
+    log=dict(required=False),
+    descr=dict(required=False)
+)
+
+
+# flags are stored as an empty element when on (floating & quick as yes) and left out when off
+rule_flags = dict(log='', disabled='', quick='yes', floating='yes')
+
+
+def canonical_value(value):
+    # None for a missing or empty value, anything else as the string pfSense would store
+    if value is None or type(value) in [dict, list]:
+        return value
+    if type(value) is bool:
+        return 'yes' if value else None
+    value = str(value).strip()
+    return value if value != '' else None
+
+
+def canonical_flag(value):
+    # yaml from an xml export gives '' or None for a flag that's on
+    if value is None:
+        return True
+    if type(value) is bool:
+        return value
+    return str(value).strip().lower() not in ['no', 'false', 'off', '0']
+
+
+def canonical_port(port):
+    # ranges are stored as from-to, or a single port when both ends match. Alias names may hold a -
+    parts = re.split('[-:]', port)
+    if len(parts) == 2 and parts[0].strip().isdigit() and parts[1].strip().isdigit():
+        parts = [str(int(p)) for p in parts]
+        return parts[0] if parts[0] == parts[1] else parts[0] + '-' + parts[1]
+    return port
+
+
+def canonical_address(address):
+    # source or destination: any & not are flags, empty values are dropped and no address at all means any
+    out = dict()
+    if type(address) is not dict:
+        address = dict()
+    for key, value in address.items():
+        if key in ['any', 'not']:
+            if canonical_flag(value):
+                out[key] = ''
+            continue
+        value = canonical_value(value)
+        if value is None:
+            continue
+        if key == 'port':
+            value = canonical_port(value)
+        out[key] = value
+    if not any(key in out for key in ['any', 'address', 'network']):
+        out['any'] = ''
+    return out
+
+
+def canonical_rule(rule):
+    # The fields this module manages, in the one form pfSense treats them, so a rule from the
+    # task and the same rule from the firewall compare equal however each was spelt
+    out = dict()
+    for key in ['type', 'tracker', 'ipprotocol', 'statetype', 'direction', 'descr', 'protocol', 'icmptype']:
+        value = canonical_value(rule.get(key))
+        if value is not None:
+            out[key] = value
+
+    # a floating rule has a list of interfaces, in no particular order
+    interface = rule.get('interface')
+    if interface is not None:
+        names = interface if type(interface) is list else str(interface).split(',')
+        names = sorted(set(str(name).strip() for name in names if str(name).strip() != ''))
+        if names:
+            out['interface'] = ','.join(names)
+
+    # protocol any is the same as none, icmptype only applies to icmp and any is the same as none
+    if out.get('protocol') == 'any':
+        del out['protocol']
+    if out.get('protocol') != 'icmp' or out.get('icmptype') == 'any':
+        out.pop('icmptype', None)
+    elif 'icmptype' in out:
+        out['icmptype'] = ','.join(sorted(t.strip() for t in out['icmptype'].split(',') if t.strip() != ''))
+    if out.get('direction') == 'any':
+        del out['direction']
+
+    for key, on in rule_flags.items():
+        if key in rule and canonical_flag(rule[key]):
+            out[key] = on
+
+    for key in ['source', 'destination']:
+        out[key] = canonical_address(rule.get(key))
+    return out
+
+
+def rule_config(module, params, rules, index, changes):
+    # Add the changes for one rule to the change set, returns (diff, updated, rule)
+    # where rule is what the PHP leaves in $config, None if it's removed
 
-    configuration = ""
     diff = False
     updated = ""
+    rule = None
 
-    pfsense_check(module)
-
-    # get config and find our rule
-    cfg = read_config(module,'filter')
-    index = search(cfg['rule'],'tracker',params['tracker'])
-
-    base = "$config['filter']['rule'][" + str(index) + "]"
+    base = ('filter', 'rule', index)
 
     if params['state'] == 'present':
 
-        if isstr(params['protocol']):
-            if params['protocol']!='icmp':
-                params['icmptype'] = None
+        # compare canonical forms, so 443 & '443' or wan,lan & lan,wan aren't a change.
+        # Options left out are None and dropped, a flag given empty is '' by now, see bulk_items()
+        wanted = canonical_rule(dict((p, v) for p, v in params.items() if v is not None))
+        current = canonical_rule(rules[index]) if index != '' else dict()
 
         for p in ['source','destination']:
-            for el in params[p]:
-                if index=='' or (el not in cfg['rule'][index][p]) or (str(cfg['rule'][index][p][el]) != str(params[p][el])):
+            for el in sorted(set(wanted[p]) | set(current.get(p, {}))):
+                if wanted[p].get(el) != current.get(p, {}).get(el):
                     diff = True
                     updated += ":"+p+"."+el
-            for (k,v) in params[p].items():
-                validate(module,p+":"+el+":"+k,v)
 
-        for p in ['type','tracker','ipprotocol','interface','direction','statetype']:
-            validate(module,p,params[p])
-            configuration += "$rule['" + p + "'] = '" + params[p] + "';\n"
-            if index=='' or (str(params[p]) != str(cfg['rule'][index][p])):
+        for p in ['type','tracker','ipprotocol','interface','direction','statetype','descr','log','disabled','quick','protocol','icmptype','floating']:
+            if wanted.get(p) != current.get(p):
                 diff = True
                 updated += ":"+p
 
-        for p in ['descr','log','disabled','quick','protocol','icmptype']:
-            if isstr(params[p]):
-                validate(module,p,params[p])
-                configuration += "$rule['" + p + "'] = '" + params[p] + "';\n"
-                if index=='' or (p not in cfg['rule'][index]) or (str(params[p]) != str(cfg['rule'][index][p])):
-                    diff = True
-                    updated += ":"+p
-
-        for p in ['floating']:
-            if type(params[p]) in [bool]:
-                configuration += "$rule['" + p + "'] = " + str(params[p]) + ";\n"
-                if index=='' or (p not in cfg['rule'][index]):
-                    diff = True
-                    updated += ":"+p
         if diff:
-            configuration += "$rule['source'] = [" + ', '.join("'%s'=>%r" % (key,val) for (key,val) in params['source'].items()) + "];\n"
-            configuration += "$rule['destination'] = [" + ', '.join("'%s'=>%r" % (key,val) for (key,val) in params['destination'].items()) + "];\n"
-            configuration += base + "=$rule;\n"
+            # the whole rule goes as one JSON document, direction as given like pfSense's GUI does
+            rule = wanted
+            rule['direction'] = params['direction']
+            changes.replace(base, rule)
+        else:
+            rule = rules[index]
 
     elif params['state'] == 'absent':
         if index != '':
-            configuration += "unset("+base+");\n"
+            changes.unset(base, reindex=True)
             diff = True
     else:
         module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
 
+    return diff, updated, rule
+
+
+def run_module():
+
+    module_args = dict(rule_args,
+        tracker=dict(required=False),
+        rules=dict(required=False, type=list),  # bulk mode, a list of rules as above
+        verify=dict(required=False, default='no', choices=['yes','no']),
+        return_state=dict(required=False, default='item', choices=['none','item','section']),
+    )
+
+    result = dict(
+        changed=False,
+    )
 
+    module = AnsibleModule(
+        argument_spec=module_args,
+        required_one_of=[['tracker','rules']],
+        mutually_exclusive=[['tracker','rules']],
+        supports_check_mode=True
+    )
+
+    params = module.params
+
+    todo = bulk_items(module, rule_args, 'rules', lambda rule: rule['tracker'], nulls=rule_flags)
+
+    changes = ChangeSet()
+    diff = False
+    statuses = []
+    touched = []
+
+    pfsense_check(module)
+
+    # get config and index our rules once for the whole list
+    cfg = read_config(module,'filter')
+    rules = cfg['rule'] if type(cfg) is dict and 'rule' in cfg else []
+    trackers = Index(rules,'tracker')
+
+    clock = timed('diff')
+    for rule in todo:
+        index = trackers.find(('tracker',rule['tracker']))
+        changed, updated, new = rule_config(module, rule, rules, index, changes)
+        if changed:
+            diff = True
+        elif index != '':
+            new = rules[index]
+        if new is not None and (changed or index != ''):
+            touched.append(new)
+        statuses.append(dict(tracker=rule['tracker'], state=rule['state'], changed=changed, updated=updated))
+    clock.stop()
+
+    configuration = changes.php()
     result['phpcode'] = configuration
-    result['updated'] = updated
+    changes_result(module, result, changes)
+    if params['rules'] is None:
+        result['updated'] = statuses[0]['updated']
+    else:
+        result['rules'] = statuses
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if diff:
-        write_config(module,configuration)
+        write_config(module,configuration,post=mark_dirty('filter'))
         result['changed'] = True
 
-    cfg = read_config(module,'filter')
-    result['filter_rules'] = cfg['rule']
+        cfg = changes.apply(dict(filter=cfg if type(cfg) is dict else dict()))['filter']
+        rules = cfg['rule']
+        if params['verify'] == 'yes':
+            verify_config(module,'filter',cfg)
+
+    return_state(module, result, 'filter_rules', rules, touched)
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
@@ -12,20 +12,41 @@ ANSIBLE_METADATA = {
 
 DOCUMENTATION = '''
 ---
-module: pfsense_config
+module: pfsense_frr_raw
 
 short_description: Loads RAW router configs into FRR
 
 description:
   - This module has been tested with BGP only at this time (April 2019).
     Other routing protocols should load into the configuration but will most likely need to be activated in the GUI.
+  - Configs are compared by a hash of their decoded text, comments and blank lines left out,
+    so re-encoding the same config is not a change.
+  - The frr and frrbgp package sections are only touched to enable FRR and give it a password
+    when it has none. Settings made in the GUI stay as they are.
+  - A change is pushed to the running daemons with vtysh, the lines that went negated and the new
+    ones added, like frr-reload does, so established BGP sessions stay up, then written to the
+    daemons' config files with write memory. frr_generate_config(),
+    which restarts the daemons, is only used when FRR wasn't running, for state=absent,
+    inside a transaction, with reload=full, or when vtysh refuses the changes.
 
 version_added: "2.7"
 
 options:
-  option:
-    bgpd:
-      - base64 encoded router configuration
+  state:
+    description: present or absent, absent removes all the raw configs
+    default: present
+  zebra:
+    description: base64 encoded router configuration
+  bgpd:
+    description: base64 encoded router configuration
+  ospfd:
+    description: base64 encoded router configuration
+  ospf6d:
+    description: base64 encoded router configuration
+  reload:
+    description: incremental pushes changes through vtysh, full restarts FRR with frr_generate_config()
+    default: incremental
+    choices: [ incremental, full ]
 
 author:
     - David Beveridge (@bevhost)
@@ -54,11 +75,140 @@ EXAMPLES = '''
 '''
 
 RETURN = '''
+reload:
+    description: how the change was applied, incremental or full
+vtysh:
+    description: the commands pushed through vtysh for an incremental reload
+phpcode:
+    description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, pfsense_check, validate, isstr
+from ansible.module_utils.pfsense import write_config, read_config, session, pfsense_check, isstr, \
+    transaction_active, php_string, add_timings, timed, ChangeSet, changes_result
+import base64
+import binascii
+import hashlib
 import os
+import re
+
+frr_inc = "/usr/local/pkg/frr.inc"
+vtysh = "/usr/local/bin/vtysh"
+
+daemons = ['zebra', 'bgpd', 'ospfd', 'ospf6d']
+
+# lines that only leave a node, the indentation already says where a command belongs
+exits = set(['exit', 'end', 'quit', 'exit-address-family', 'exit-vrf', 'exit-vnc'])
+
+# negating these takes the whole neighbor or peer-group, not just the one setting
+takes_along = re.compile(r'^neighbor \S+ (remote-as|interface|peer-group)\b')
+
+
+def package_config(packages, name):
+    # $config['installedpackages'][name]['config'][0], {} if there isn't one
+    try:
+        item = packages[name]['config'][0]
+    except (KeyError, IndexError, TypeError):
+        return dict()
+    return item if isinstance(item, dict) else dict()
+
+
+def frr_decode(module, name, value):
+    # the text of a base64 encoded config, '' for none
+    if not isstr(value) or value == '':
+        return ''
+    error = 'not base64'
+    if re.match(r'^[A-Za-z0-9+/=\s]*$', value):
+        try:
+            return base64.b64decode(value).decode('utf-8')
+        except (TypeError, ValueError, binascii.Error) as e:
+            error = str(e)
+    module.fail_json(msg=name+' is not base64 encoded text', error=error)
+
+
+def frr_lines(text):
+    # the lines FRR acts on, without comments, blank lines or trailing blanks
+    lines = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if line.strip() == '' or line.lstrip().startswith('!'):
+            continue
+        lines.append(line)
+    return lines
+
+
+def frr_hash(text):
+    return hashlib.sha256("\n".join(frr_lines(text)).encode('utf-8')).hexdigest()
+
+
+def frr_tree(text):
+    # (context, command) for each line, the context being the lines above it
+    # with less indentation, e.g. ('router bgp 65000', 'address-family ipv4 unicast')
+    entries = []
+    stack = []
+    for line in frr_lines(text):
+        indent = len(line) - len(line.lstrip())
+        line = line.strip()
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        if line in exits:
+            continue
+        entries.append((tuple(l for i, l in stack), line))
+        stack.append((indent, line))
+    return entries
+
+
+def frr_commands(old, new):
+    # vtysh commands that take the daemons from the old config text to the new one.
+    # Like frr-reload: what went is negated, deepest first and not under a node that
+    # goes too, then what's new is added in file order. Negating "neighbor X remote-as"
+    # takes the rest of neighbor X with it, so what's kept of neighbor X is added again.
+    before = frr_tree(old)
+    after = frr_tree(new)
+    before_set = set(before)
+    after_set = set(after)
+    removed = [e for e in before if e not in after_set]
+    added = set(e for e in after if e not in before_set)
+    gone = set(context + (line,) for context, line in removed)
+    starts = dict()     # the new lines by their first two words, e.g. ('neighbor', X)
+    for c, l in after:
+        starts.setdefault(tuple(l.split()[:2]), []).append((c, l))
+    steps = []
+    for context, line in reversed(removed):
+        if any(context[:i] in gone for i in range(1, len(context) + 1)):
+            continue
+        steps.append((context, line[3:] if line.startswith('no ') else 'no ' + line))
+        if takes_along.match(line):
+            for c, l in starts.get(tuple(line.split()[:2]), []):
+                if c[:len(context)] == context:
+                    added.add((c, l))
+    steps.extend(e for e in after if e in added)
+
+    commands = []
+    current = None
+    for context, line in steps:
+        if context != current:
+            if current is not None:
+                commands.append('end')
+            commands.append('configure terminal')
+            commands.extend(context)
+            current = context
+        commands.append(line)
+    if commands:
+        commands.append('end')
+    return commands
+
+
+def frr_reload(module, commands):
+    # push the commands to the running daemons, False if vtysh didn't take all of them
+    if not os.path.isfile(vtysh):
+        return False
+    args = [vtysh]
+    for c in commands:
+        args += ['-c', c]
+    with timed('vtysh'):
+        rc, out, err = module.run_command(args)
+    return rc == 0 and not re.search(r'^% ', out + err, re.M)
 
 
 def run_module():
@@ -68,70 +218,100 @@ def run_module():
         zebra=dict(required=False),
         bgpd=dict(required=False),
         ospfd=dict(required=False),
-        ospf6d=dict(required=False)
+        ospf6d=dict(required=False),
+        reload=dict(required=False,default='incremental',choices=['incremental','full'])
     )
 
-    args = ['zebra','bgpd','ospfd','ospf6d']
-
     result = dict(
         changed=False,
     )
 
     module = AnsibleModule(
         argument_spec=module_args,
-        required_one_of=[args],
+        required_one_of=[daemons],
         supports_check_mode=True
     )
 
     params = module.params
 
-    configuration = ""
+    changes = ChangeSet()
 
     pfsense_check(module)
-    if not os.path.isfile('/usr/local/pkg/frr.inc'):
+    if not os.path.isfile(frr_inc):
         module.fail_json(msg='pfsense-pkg-frr package not installed')
 
-    index=0
-    cfg = read_config(module,'installedpackages')
-    try:
-        frr = cfg['frrglobalraw']['config'][0]
-    except:
-        index = ""
+    packages = read_config(module,'installedpackages')
+    if not isinstance(packages, dict):
+        packages = dict()
+    raw = package_config(packages, 'frrglobalraw')
+    frr = package_config(packages, 'frr')
+    frrbgp = package_config(packages, 'frrbgp')
 
-    base = "$config['installedpackages']['frrglobalraw']['config'][0]"
+    clock = timed('diff')
+    base = ('installedpackages', 'frrglobalraw', 'config', 0)
+    texts = dict()      # daemon: (old, new) decoded config
     if params['state'] == 'present':
-        for p in args:
+        for p in daemons:
             if isstr(params[p]):
-                validate(module,p,params[p])
-                if index=="" or (p in frr and params[p] != frr[p]):
-                    configuration += base + "['"+p+"']='" + params[p] + "';\n"
+                old = frr_decode(module, p, raw.get(p))
+                new = frr_decode(module, p, params[p])
+                if p not in raw or frr_hash(new) != frr_hash(old):
+                    changes.set(base + (p,), params[p])
+                    texts[p] = (old, new)
     elif params['state'] == 'absent':
-        if index != '':
-            configuration += "unset("+base+");\n"
+        if raw:
+            changes.unset(base)
     else:
         module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
 
-
-    result['phpcode'] = configuration
+    # FRR has to be on for the raw configs to be loaded, the rest of the GUI settings stay
+    running = frr.get('enable') == 'on' and frrbgp.get('enable') == 'on'
+    if texts:
+        if frr.get('enable') != 'on':
+            changes.set(('installedpackages', 'frr', 'config', 0, 'enable'), 'on')
+        if not frr.get('password'):
+            changes.set(('installedpackages', 'frr', 'config', 0, 'password'), binascii.hexlify(os.urandom(8)).decode('ascii'))
+        if frrbgp.get('enable') != 'on':
+            changes.set(('installedpackages', 'frrbgp', 'config', 0, 'enable'), 'on')
+
+    # the daemons run what the raw configs said, unless a daemon had none and runs the GUI's
+    incremental = params['reload'] == 'incremental' and running and params['state'] == 'present' \
+        and all(raw.get(p) for p in texts) and not transaction_active()
+    commands = []
+    if incremental:
+        for p in daemons:
+            if p in texts:
+                commands += frr_commands(*texts[p])
+    if commands:
+        # vtysh stops at the first command refused, so the daemons only save what they run
+        # to /var/etc/frr/*.conf once they took all of the change
+        commands.append('write memory')
+    clock.stop()
+
+    result['phpcode'] = changes.php()
+    changes_result(module, result, changes)
+    if len(changes):
+        result['reload'] = 'incremental' if incremental else 'full'
+        if incremental:
+            result['vtysh'] = commands
 
     if module.check_mode:
-        module.exit_json(**result)
-    if configuration != '':
-        # uncomment these to overwrite gui config
-        configuration += "unset($config['installedpackages']['frr']);\n"
-        configuration += "unset($config['installedpackages']['frrbgp']);\n"
-        configuration += "$frr['enable']='on';\n";
-        configuration += "$config['installedpackages']['frrbgp']['config']=$frr;\n";
-        configuration += "$frr['password']=uniqid();\n";
-        configuration += "$config['installedpackages']['frr']['config']=$frr;\n"
-        # Write new config
-        configuration += "write_config();\n;"
-        # Apply the config
-        configuration += "include('/usr/local/pkg/frr.inc');frr_generate_config();\n"
-        write_config(module,configuration)
+        module.exit_json(**add_timings(result))
+    if len(changes):
+        configuration = changes.php()
+        full = "include(" + php_string(frr_inc) + ");frr_generate_config();\n"
+        if incremental:
+            # the raw configs stay in config.xml for frr_generate_config() on the next boot
+            write_config(module,configuration)
+            if commands and not frr_reload(module, commands):
+                result['reload'] = 'full'
+                session(module).run(full, 'error reloading FRR', 'frr')
+        else:
+            # Write new config, then apply it
+            write_config(module,configuration,post=full)
         result['changed'] = True
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
@@ -16,7 +16,10 @@ module: pfsense_group
 
 short_description: Creates a usergroup
 
-description: Creates a group usable by LDAP or Local Auth etc
+description:
+  - Creates a group usable by LDAP or Local Auth etc
+  - Given a list in 'groups', the groups, users & nextgid are read once, new groups get a block of
+    consecutive GIDs and all changes are written with a single write_config().
 
 version_added: "2.7"
 
@@ -29,11 +32,29 @@ options:
     default: remote
     required: false
   priv:
-    description: Privileges assigned to users in this group
-    required: true
+    description: Privileges assigned to users in this group, compared as a set
+    required: true, to add a group
     possible values:
         see example below; or create a group in the GUI and export it 
         or look at the config diff in diagnostics/backup & restore/config history
+  member:
+    description: user names to make members of this group
+    required: false
+  exclusive:
+    description: yes removes the members not listed in member, no only adds them
+    default: no
+    required: false
+  groups:
+    description: bulk mode, a list of groups each with the options above, instead of name etc.
+    required: false
+  verify:
+    description: check the groups written against the firewall's copy, rather than trust the computed result
+    default: no
+    required: false
+  return_state:
+    description: item returns just this group, section all groups, none leaves them out of the result
+    default: item
+    required: false
 author:
     - David Beveridge (@bevhost)
 
@@ -62,30 +83,109 @@ EXAMPLES = '''
     - page-dashboard-widgets
 #    - user-shell-access
 
+- name: Role groups, with exactly these members
+  pfsense_group:
+    groups:
+      - name: netops
+        priv:
+          - page-dashboard-all
+        member:
+          - alice
+          - bob
+        exclusive: yes
+      - name: old_role
+        state: absent
+
 '''
 
 RETURN = '''
 group:
-    description: dict containing all user groups
+    description: list holding this group or the groups given, or with return_state=section all user groups
+groups:
+    description: in bulk mode, name, state & changed for each group
 debug:
     description: Any debug messages for unexpected input types
     type: str
+changes:
+    description: with --diff, the changes made to the system section as a list of op, path & value
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, search, pfsense_check, validate, isstr
+from ansible.module_utils.pfsense import write_config, read_config, verify_config, return_state, Index, pfsense_check, validate, isstr, \
+    bulk_items, php_value, add_timings, timed, ChangeSet, changes_result
+
+
+group_args = dict(
+    name=dict(required=True),
+    scope=dict(required=False, default='remote', choices=['local','remote']),
+    description=dict(required=False, default=''),
+    priv=dict(required=False, type=list),
+    member=dict(required=False, type=list),
+    exclusive=dict(required=False, default='no', choices=['yes','no']),
+    state=dict(required=False, default='present', choices=['present', 'absent']),
+)
+
+
+def group_config(module, params, groups, index, uids, gid, changes):
+    # Add the changes for one group to the change set, returns (diff, group)
+    # where group is what the PHP leaves in $config, None if it's removed.
+    # gid is the one a new group gets, uids maps user names to their uid.
+
+    validate(module,'name',params['name'],'^[a-zA-Z0-9_.][a-zA-Z0-9_.-]{0,30}[a-zA-Z0-9_.$-]$')
+
+    diff = False
+    base = ('system', 'group', index)
+    group = dict() if index=='' else dict(groups[index])
+
+    if params['state'] == 'present':
+        if index=='' and params['priv'] is None:
+            module.fail_json(msg='priv is needed to add group '+params['name'])
+        fields = dict()
+        for p in ['name','description','scope']:
+            if isstr(params[p]) and (index=='' or groups[index].get(p) != params[p]):
+                fields[p] = params[p]
+        if index=='':
+            fields['gid'] = gid
+        if params['priv'] is not None and (index=='' or set(groups[index].get('priv',[])) != set(params['priv'])):
+            fields['priv'] = params['priv']
+        if params['member'] is not None:
+            current = group.get('member', [])
+            if not isinstance(current, list):
+                current = [current]
+            for name in params['member']:
+                if name not in uids:
+                    module.fail_json(msg='group '+params['name']+': no such user '+str(name))
+            wanted = [uids[name] for name in params['member']]
+            if params['exclusive'] == 'no':
+                wanted = current + [uid for uid in wanted if uid not in current]
+            if set(current) != set(wanted):
+                fields['member'] = wanted
+        group.update(fields)
+        if index=='':
+            changes.append(base[:-1], group)
+        elif fields:
+            changes.update(base, fields)
+        diff = bool(fields)
+    elif params['state'] == 'absent':
+        if index != '':
+            changes.unset(base, reindex=True)
+            diff = True
+        group = None
+    else:
+        module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
+
+    return diff, group
 
 
 def run_module():
 
-    module_args = dict(
-        name=dict(required=True, default=None),
-        scope=dict(required=False, default='remote', choices=['local','remote']),
-        description=dict(required=False, default=''),
-        priv=dict(required=True, type=list),
-        state=dict(required=False, default='present', choices=['present', 'absent'])
+    module_args = dict(group_args,
+        name=dict(required=False),
+        groups=dict(required=False, type=list),     # bulk mode, a list of groups as above
+        verify=dict(required=False, default='no', choices=['yes','no']),
+        return_state=dict(required=False, default='item', choices=['none','item','section'])
     )
 
     result = dict(
@@ -94,62 +194,76 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[['name','groups']],
+        mutually_exclusive=[['name','groups']],
         supports_check_mode=True
     )
 
     params = module.params
-    priv = params['priv']
-
-    configuration = ""
-
-    pfsense_check(module)
-
-    validate(module,'name',params['name'],'^[a-zA-Z0-9_.][a-zA-Z0-9_.-]{0,30}[a-zA-Z0-9_.$-]$')
-    validate(module,'priv',params['priv'])
 
-    system = read_config(module,'system')
-    index = search(system['group'],'name',params['name'])
-    if index=='':
-        gid = system['nextgid']
-        configuration += "$config['system']['nextgid']++;\n"
-    else:
-        gid = system['group'][index]['gid']
+    changes = ChangeSet()
 
-    base = "$config['system']['group'][" + str(index) + "]"
-    if params['state'] == 'present':
-        for p in ['name','description','scope']:
-            if isstr(params[p]):
-                validate(module,p,params[p])
-                if index=='':
-                    configuration += "$group['"+p+"']='" + params[p] + "';\n"
-                elif system['group'][index][p] != params[p]:
-                    configuration += base + "['"+p+"']='" + params[p] + "';\n"
-        if index=='':
-            configuration += "$group['gid']='" + gid + "';\n"
-            configuration += "$group['priv']=['"+"','".join(priv)+"'];\n"
-            configuration += base + "=$group;\n"
-        elif set(system['group'][index]['priv']) != set(priv):
-            configuration += base + "['priv']=['"+"','".join(priv)+"'];\n"
+    todo = bulk_items(module, group_args, 'groups', lambda item: item['name'])
 
-    elif params['state'] == 'absent':
-        if index != '':
-            configuration += "unset("+base+");\n"
-    else:
-        module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
+    pfsense_check(module)
 
+    # only the groups, nextgid and, for members, the users, rather than all of system
+    sections = ['system/group', 'system/nextgid']
+    if any(item['member'] is not None for item in todo):
+        sections.append('system/user')
+    cfg = read_config(module, sections)
+    groups = cfg['system/group'] if type(cfg['system/group']) is list else []
+    users = cfg.get('system/user') if type(cfg.get('system/user')) is list else []
+    nextgid = int(cfg['system/nextgid']) if isstr(cfg['system/nextgid']) and cfg['system/nextgid'].isdigit() else 2000
+    names = Index(groups, 'name')
+    uids = dict((u['name'], u['uid']) for u in users if isinstance(u, dict) and 'name' in u and 'uid' in u)
+
+    clock = timed('diff')
+    statuses = []
+    touched = []
+    members = []    # groups whose members the OS needs to hear about
+    gid = nextgid
+    for item in todo:
+        index = names.find(('name', item['name']))
+        changed, group = group_config(module, item, groups, index, uids, str(gid), changes)
+        if index == '' and group is not None:
+            gid += 1
+        if group is not None:
+            touched.append(group)
+            # emptied too, or /etc/group keeps the members config.xml lost
+            if 'member' in group and (index == '' or groups[index].get('member') != group['member']):
+                members.append(item['name'])
+        statuses.append(dict(name=item['name'], state=item['state'], changed=changed))
+    # new groups take a block of GIDs, nextgid moves past it once
+    if gid != nextgid:
+        changes.set(('system', 'nextgid'), str(gid))
+    clock.stop()
+
+    configuration = changes.php()
     result['phpcode'] = configuration
+    if params['groups'] is not None:
+        result['groups'] = statuses
+    changes_result(module, result, changes)
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
-        write_config(module,configuration)
+        post = ''
+        if members:
+            post = 'require_once("auth.inc");\n' + \
+                "foreach ($config['system']['group'] as $group) if (in_array($group['name'], " + \
+                php_value(members) + ", true)) local_group_set($group);\n"
+        write_config(module,configuration,post=post)
         result['changed'] = True
 
-    cfg = read_config(module,'system')
-    result['group'] = cfg['group']
+        groups = changes.apply(dict(system=dict(group=groups)))['system']['group']
+        if params['verify'] == 'yes':
+            verify_config(module,'system/group',groups)
+
+    return_state(module, result, 'group', groups, touched)
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
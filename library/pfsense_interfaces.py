@@ -20,6 +20,9 @@ description:
     - Since I only used static IPv4 config, that's pretty much all I've tested
       Additional config fields could be added without too much trouble.
     - Also includes a 'gateway' parameter which can create a Default_GW
+    - The interfaces and gateways are returned as computed, set verify: yes to check them against the firewall
+    - return_state: item (default) returns just this interface & its gateway, section the whole
+      interfaces & gateways sections, none neither
 
 version_added: "2.7"
 
@@ -52,15 +55,18 @@ EXAMPLES = '''
 
 RETURN = '''
 interfaces:
-    description: dictionary of interfaces
+    description: dictionary holding this interface, or with return_state=section all interfaces
 gateways:
-    description: dictionary of gateways
+    description: dictionary holding this interface's gateway, or with return_state=section all gateways
+changes:
+    description: with --diff, the changes made to the interfaces & gateways sections as a list of op, path & value
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, search, pfsense_check, validate
+from ansible.module_utils.pfsense import write_config, read_config, verify_config, return_state, search, pfsense_check, add_timings, timed, mark_dirty, ChangeSet, changes_result
+from collections import OrderedDict
 
 
 def run_module():
@@ -74,7 +80,9 @@ def run_module():
         gateway=dict(required=False),
         gateway_name=dict(required=False,default='Default_GW'),
         gateway_weight=dict(required=False,default='1'),
-        descr=dict(required=False,default='')
+        descr=dict(required=False,default=''),
+        verify=dict(required=False, default='no', choices=['yes','no']),
+        return_state=dict(required=False, default='item', choices=['none','item','section'])
     )
 
     result = dict(
@@ -89,13 +97,14 @@ def run_module():
     params = module.params
 
     section = 'interfaces'
-    configuration = ""
+    changes = ChangeSet()
 
     pfsense_check(module)
 
 
     name = params['name']
-    cfg = read_config(module,section)
+    current = read_config(module,['interfaces','gateways'])
+    cfg = current['interfaces']
 
     try:
         if cfg[name]:
@@ -103,58 +112,67 @@ def run_module():
     except:
         module.fail_json(msg='interface ' + name + ' not found')
 
-    interface = "$config['"+section+"']['" + name + "']"
+    interface = (section, name)
 
+    clock = timed('diff')
     # Interface Params
     for key in ['ipaddr','subnet','descr']:
         if params[key]:
             if not key in cfg[name] or params[key] != cfg[name][key]:
-                validate(module,key,params[key])
-                configuration += interface + "['"+key+"']='" + params[key] + "';\n"
+                changes.set(interface + (key,), params[key])
 
     # Handle enable param
     if params['enable'] and 'enable' not in cfg[name]:
-        configuration += interface + "['enable']='';\n"
+        changes.set(interface + ('enable',), '')
     if not params['enable'] and 'enable' in cfg[name]:
-        configuration += "unset(" + interface + "['enable']);\n"
+        changes.unset(interface + ('enable',))
 
     # Setup Gateway if provided, (should really be in its own pfsense_gateways module)
     section = 'gateways'
     gw_diff = False
+    gw_items = []
     gw_params = {'name':'interface','gateway':'gateway','gateway_name':'name','gateway_weight':'weight'}
     if params['gateway']:
-        gateways = read_config(module,section)
+        gateways = current['gateways']
         gw = search(gateways['gateway_item'],'name',params['gateway_name'])
         if gw=='':
             gw_diff = True
         else:
             for p, key in gw_params.items():
                 if p in params:
-                    validate(module,p,params[p])
                     if (key not in gateways['gateway_item'][gw]) or (params[p] != gateways['gateway_item'][gw][key]):
                         gw_diff = True
+            gw_items = [gateways['gateway_item'][gw]]
 
     if gw_diff:
-        configuration += interface + "['gateway']='" + params['gateway_name'] + "';\n"
-        configuration += "$config['gateways']['gateway_item'][" + gw + "]=[\n";
-        configuration += "'interface'=>'" + params['name'] + "',\n"
-        configuration += "'gateway'=>'" + params['gateway'] + "',\n"
-        configuration += "'name'=>'" + params['gateway_name'] + "',\n"
-        configuration += "'weight'=>'" + params['gateway_weight'] + "'];"
-
+        item = OrderedDict([('interface', params['name']), ('gateway', params['gateway']),
+                            ('name', params['gateway_name']), ('weight', params['gateway_weight'])])
+        changes.set(interface + ('gateway',), params['gateway_name'])
+        changes.replace(('gateways', 'gateway_item', gw), item)
+        gw_items = [item]
+    clock.stop()
+
+    configuration = changes.php()
     result['phpcode'] = configuration
+    changes_result(module, result, changes)
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
-        write_config(module,configuration)
+        # rules on the interface are rebuilt along with it
+        write_config(module,configuration,post=mark_dirty('interfaces')+mark_dirty('filter'))
         result['changed'] = True
 
-    for section in ['interfaces','gateways']:
-        result[section] = read_config(module,section)
+        current = changes.apply(current)
+        if params['verify'] == 'yes':
+            verify_config(module,'interfaces',current['interfaces'])
+            verify_config(module,'gateways',current['gateways'])
+
+    return_state(module, result, 'interfaces', current['interfaces'], {name: current['interfaces'][name]})
+    return_state(module, result, 'gateways', current['gateways'], dict(gateway_item=gw_items))
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
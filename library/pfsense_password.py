@@ -29,6 +29,10 @@ options:
   authorizedkeys:  
     description: can contain more than one key, don't forget to base64 encode 
     required: false
+  return_state:
+    description: item returns just this user, section all users, none skips reading them back
+    default: item
+    required: false
 
 author:
     - David Beveridge (@bevhost)
@@ -58,13 +62,13 @@ EXAMPLES = '''
 
 RETURN = '''
 user:
-    description: dict containing data structure for webgui users
+    description: list holding this user, or with return_state=section all webgui users
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, search, pfsense_check, validate, isstr
+from ansible.module_utils.pfsense import write_config, read_config, return_state, search, pfsense_check, isstr, add_timings, timed, php_path, php_value, ChangeSet
 
 
 def run_module():
@@ -72,7 +76,8 @@ def run_module():
     module_args = dict(
         username=dict(required=True, default=None),
         password=dict(required=True, default=None),
-        authorizedkeys=dict(required=False, default='')
+        authorizedkeys=dict(required=False, default=''),
+        return_state=dict(required=False, default='item', choices=['none','item','section'])
     )
 
     result = dict(
@@ -86,7 +91,7 @@ def run_module():
 
     params = module.params
 
-    configuration = ""
+    changes = ChangeSet()
     
     pfsense_check(module)
 
@@ -96,27 +101,33 @@ def run_module():
     if index == '':
         module.fail_json(msg='username: ' + params['username'] + ' not found' )
 
-    base = "$config['system']['user'][" + str(index) + "]"
-    for p in ['password','authorizedkeys']:
-        if isstr(params[p]):
-            validate(module,p,params[p])
-            if p not in system['user'][index] or system['user'][index][p] != params[p]:
-                configuration += base + "['"+p+"']='" + params[p] + "';\n"
-
+    clock = timed('diff')
+    base = ('system', 'user', index)
+    fields = [p for p in ['password','authorizedkeys'] if isstr(params[p]) and
+              (p not in system['user'][index] or system['user'][index][p] != params[p])]
+    if fields:
+        changes.statement('require_once("auth.inc");')
+        for p in fields:
+            changes.set(base + (p,), params[p])
+        changes.statement("local_user_set_password(" + php_path(*base) + ", " + php_value(params['password']) + ");")
+    clock.stop()
+
+    # no --diff changes here, they'd only show the password in clear text
+    configuration = changes.php()
     result['phpcode'] = configuration
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
-        configuration = 'require_once("auth.inc");\n'+configuration
-        configuration += "local_user_set_password($config['system']['user']["+str(index)+"], '"+params['password']+"');\n"
-        write_config(module,configuration,post="local_user_set($config['system']['user']["+str(index)+"]);")
+        write_config(module,configuration,post="local_user_set(" + php_path(*base) + ");")
         result['changed'] = True
 
-    system = read_config(module,'system')
-    result['user'] = system['user']
+    # the password hash is made on the firewall, so the user has to be read back
+    if params['return_state'] != 'none':
+        users = read_config(module,'system/user')
+        return_state(module, result, 'user', users, [users[index]])
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
@@ -16,6 +16,10 @@ module: pfsense_virtualip
 
 short_description: Creates a Virtual IP Address on an interface in pfSense
 
+description:
+    - The virtualip section is returned as computed, set verify: yes to check it against the firewall
+    - return_state: item (default) returns just this vip, section every vip, none nothing
+
 version_added: "2.7"
 
 
@@ -53,13 +57,15 @@ EXAMPLES = '''
 
 RETURN = '''
 virtualip:
-    description: dict containing data structure for all virtual ips
+    description: dict holding this virtual ip, or with return_state=section all virtual ips
+changes:
+    description: with --diff, the changes made to the virtualip section as a list of op, path & value
 phpcode:
     description: Actual PHP Code sent to pfSense PHP Shell
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.pfsense import write_config, read_config, search, pfsense_check, validate, isstr
+from ansible.module_utils.pfsense import write_config, read_config, verify_config, return_state, Index, pfsense_check, isstr, add_timings, timed, mark_dirty, ChangeSet, changes_result
 import time
 
 
@@ -81,7 +87,9 @@ def run_module():
         password=dict(required=False, default=''),
         advbase=dict(required=False, default='1'),
         advskew=dict(required=False, default='0'),
-        descr=dict(required=False,default='')
+        descr=dict(required=False,default=''),
+        verify=dict(required=False, default='no', choices=['yes','no']),
+        return_state=dict(required=False, default='item', choices=['none','item','section'])
     )
 
     result = dict(
@@ -94,7 +102,7 @@ def run_module():
     )
 
     section = 'virtualip'
-    configuration = ""
+    changes = ChangeSet()
     params = module.params
 
     pfsense_check(module)
@@ -103,42 +111,53 @@ def run_module():
 
     index=''
     if type(cfg) is dict and 'vip' in cfg:
-       if isstr(params['uniqid']):
-           index = search(cfg['vip'],'uniqid',params['uniqid'])
-       else:
-           params['uniqid'] = uniqid()
+       vips = Index(cfg['vip'],'uniqid','subnet')
+       index = vips.find(('uniqid',params['uniqid']),('subnet',params['subnet']))
+    if not isstr(params['uniqid']):
        if index=='':
-           index = search(cfg['vip'],'subnet',params['subnet'])
+           params['uniqid'] = uniqid()
+       else:
+           params['uniqid'] = cfg['vip'][index].get('uniqid',uniqid())
 
-    base = "$config['virtualip']['vip'][" + str(index) + "]"
+    clock = timed('diff')
+    base = ('virtualip', 'vip', index)
+    vip = dict() if index=='' else dict(cfg['vip'][index])
     if params['state'] == 'present':
+        fields = dict()
         for p in ['mode','type','uniqid','interface','descr','subnet','subnet_bits','vhid','password','advbase','advskew']:
-            if isstr(params[p]):
-                validate(module,p,params[p])
-                if index=='':
-                    configuration += "$virtualip['"+p+"']='" + params[p] + "';\n"
-                elif cfg[index][p] != params[p]:
-                    configuration += base + "['"+p+"']='" + params[p] + "';\n"
+            if isstr(params[p]) and (index=='' or cfg['vip'][index].get(p) != params[p]):
+                fields[p] = params[p]
+        vip.update(fields)
         if index=='':
-            configuration += base + "=$virtualip;\n"
+            changes.append(base[:-1], vip)
+        elif fields:
+            changes.update(base, fields)
     elif params['state'] == 'absent':
         if index != '':
-            configuration += "unset("+base+");\n"
+            changes.unset(base, reindex=True)
+        vip = None
     else:
         module.fail_json(msg='Incorrect state value, possible choices: absent, present(default)')
+    clock.stop()
 
+    configuration = changes.php()
     result['phpcode'] = configuration
+    changes_result(module, result, changes)
 
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**add_timings(result))
 
     if configuration != '':
-        write_config(module,configuration)
+        write_config(module,configuration,post=mark_dirty('vip'))
         result['changed'] = True
 
-    result[section] = read_config(module,section)
+        cfg = changes.apply(dict(virtualip=cfg if type(cfg) is dict else dict()))[section]
+        if params['verify'] == 'yes':
+            verify_config(module,section,cfg)
+
+    return_state(module, result, section, cfg, dict(vip=[vip] if vip is not None else []))
 
-    module.exit_json(**result)
+    module.exit_json(**add_timings(result))
 
 def main():
     run_module()
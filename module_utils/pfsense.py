@@ -1,7 +1,16 @@
+import atexit
+import copy
+import hashlib
 import json
 import os
 import platform
 import re
+import subprocess
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
 
 try:
     isinstance("", basestring)
@@ -12,53 +21,865 @@ except NameError:
         return isinstance(s, str)
 
 cmd = "/usr/local/sbin/pfSsh.php"
+prompt = "pfSense shell: "
+config_file = "/cf/conf/config.xml"
+state_dir = "/var/run/ansible_pfsense"
+cache_dir = state_dir + "/cache"
+queue_file = state_dir + "/transaction.queue"
+snapshot_file = state_dir + "/transaction.snapshot"
+read_backend = os.environ.get('PFSENSE_READ_BACKEND', 'php')
+timing = os.environ.get('PFSENSE_TIMINGS', 'no').lower() in ['1', 'yes', 'true', 'on']
+
+# Tags pfSense always loads as arrays, from listtags() & listtags_pkg() in xmlparse.inc
+listtags = set([
+    'acls', 'alias', 'aliasurl', 'allowedip', 'allowedhostname', 'authserver',
+    'bridged', 'build_port_path',
+    'ca', 'cacert', 'cert', 'crl', 'clone', 'config', 'container',
+    'columnitem', 'checkipservice',
+    'depends_on_package', 'disk', 'dnsserver', 'dnsupdate', 'domainoverrides', 'dyndns',
+    'earlyshellcmd', 'element', 'encryption-algorithm-option',
+    'field', 'fieldname',
+    'gateway_item', 'gateway_group', 'gif', 'gre', 'group',
+    'hash-algorithm-option', 'hosts', 'ifgroupentry', 'igmpentry', 'interface_array', 'item', 'key',
+    'lagg', 'lbaction', 'lbpool', 'l7rules', 'lbprotocol',
+    'member', 'menu', 'tab', 'mobilekey', 'monitor_type', 'mount',
+    'npt', 'ntpserver',
+    'onetoone', 'openvpn-server', 'openvpn-client', 'openvpn-csc', 'option',
+    'package', 'passthrumac', 'phase1', 'phase2', 'ppp', 'pppoe', 'priv', 'proxyarpnet', 'pool',
+    'qinqentry', 'queue',
+    'pages', 'pipe', 'radnsserver', 'roll', 'route', 'row', 'rrddatafile', 'rule',
+    'schedule', 'service', 'servernat', 'servers',
+    'serversdisabled', 'shellcmd', 'staticmap', 'subqueue', 'switch', 'swport',
+    'timerange', 'tunnel', 'user', 'vip', 'virtual_server', 'vlan',
+    'winsserver', 'wolentry', 'widget', 'xmlrpcdomainoverride'
+])
+
+# Keys holding base64 certificate & key bodies, never sent back to the controller
+blobs = set(['crt', 'prv'])
+
+# Seconds, calls & bytes per phase of this module run, see add_timings()
+timings = dict()
+
+
+def timing_add(phase, seconds, **counts):
+    t = timings.setdefault(phase, dict(seconds=0.0, calls=0))
+    t['seconds'] += seconds
+    t['calls'] += 1
+    for k, v in counts.items():
+        t[k] = t.get(k, 0) + v
+
+
+class timed(object):
+    # Adds wall time to a phase, around a with block or from creation until stop()
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.begin = time.time()
+
+    def stop(self):
+        timing_add(self.phase, time.time() - self.begin)
+
+    def __enter__(self):
+        self.begin = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+def add_timings(result):
+    # Only with PFSENSE_TIMINGS set in the task environment, so results stay small otherwise
+    if timing:
+        result['timings'] = dict((phase, dict(t, seconds=round(t['seconds'], 6))) for phase, t in timings.items())
+    return result
+
+
+class PfSsh(object):
+    # One long running pfSsh.php per module run, so that PHP only loads
+    # config.inc & $config once for all the reads and writes we do.
+    # Each request is framed by marker lines echoed from PHP, built by
+    # concatenation so the markers never appear in any echoed source.
+
+    def __init__(self, module, command=None):
+        self.module = module
+        self.command = command or cmd
+        self.proc = None
+        self.errors = None
+        self.serial = 0
+        self.replayed = None
+
+    def start(self):
+        self.errors = tempfile.TemporaryFile()
+        self.replayed = None    # the queued writes this shell's $txn has applied, see transaction_php()
+        try:
+            self.proc = subprocess.Popen([self.command], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.errors)
+        except OSError as e:
+            self.module.fail_json(msg='unable to start '+self.command, error=str(e))
+        atexit.register(self.close)
+
+    def marker(self, name):
+        return "@@pfsense-" + str(self.serial) + "-" + name + "@@"
+
+    def frame(self, name):
+        return 'echo "\\n" . implode("-", ["@@pfsense", "' + str(self.serial) + '", "' + name + '@@"]) . "\\n";\nexec\n'
+
+    def stderr(self):
+        self.errors.seek(0)
+        return self.errors.read().decode('utf-8', 'replace')
+
+    def run(self, php, msg='error running php', phase='php'):
+        # phase names the request in timings, the first one also times PHP starting up
+        begun = time.time()
+        if self.proc is None:
+            self.start()
+        self.serial += 1
+        request = (self.frame('begin') + php + '\nexec\n' + self.frame('end')).encode('utf-8')
+
+        # write from a thread so a chatty shell can't fill the stdout pipe and deadlock us
+        def send():
+            try:
+                self.proc.stdin.write(request)
+                self.proc.stdin.flush()
+            except (IOError, OSError):
+                pass
+        writer = threading.Thread(target=send)
+        writer.start()
+
+        begin = self.marker('begin')
+        end = self.marker('end')
+        lines = []
+        started = False
+        received = 0
+        while True:
+            line = self.proc.stdout.readline()
+            received += len(line)
+            line = line.decode('utf-8', 'replace')
+            if line == '':
+                writer.join()
+                rc = self.proc.wait()
+                self.proc = None
+                self.module.fail_json(msg=msg, rc=rc, error=self.stderr(), output=''.join(lines))
+            text = line.rstrip('\r\n')
+            if not started:
+                started = text == begin
+                if started and self.serial == 1:
+                    timing_add('start', time.time() - begun)
+                    begun = time.time()
+            elif text == end:
+                break
+            elif not text.startswith(prompt):
+                lines.append(line)
+        writer.join()
+        timing_add(phase, time.time() - begun, sent=len(request), received=received)
+        return ''.join(lines)
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.write(b'exit\n')
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.proc.wait()
+            self.proc = None
+
+
+def session(module):
+    if getattr(module, '_pfsense_session', None) is None:
+        module._pfsense_session = PfSsh(module)
+    return module._pfsense_session
 
 
 def write_config(module, configuration, post=""):
 
-    php = configuration+'\nwrite_config();\n'+post+'\nexec\nexit\n'
+    # inside a transaction (see pfsense_commit) changes wait in the queue for the commit
+    if transaction_active():
+        queue_config(module, configuration, post)
+        return
 
-    rc, out, err = module.run_command(cmd,data=php)
-    if rc != 0:
-        module.fail_json(msg='error writing config',error=err, output=out)
+    cache_clear()
+    php = configuration+'\nwrite_config();\n'+post
+    session(module).run(php, 'error writing config', 'write')
+    cache_clear()
 
 
-def read_config(module, section = None):
+def transaction_active():
+    return os.path.exists(queue_file)
+
+
+def transaction_header(module):
+    # the queue's first line, naming the transaction, when it began and its timeout
+    try:
+        with open(queue_file) as f:
+            header = json.loads(f.readline() or '{}')
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg='error reading '+queue_file, error=str(e))
+    return header if 'transaction' in header else dict()
+
+
+def transaction_check(module):
+    # A queue belongs to the run that began it. With PFSENSE_TRANSACTION exported (see pfsense_commit)
+    # it has to be that transaction, without it the queue must have been used within its timeout.
+    # Anything else was left by a failed run, queueing onto it would lose the write.
+    if not transaction_active():
+        return
+    header = transaction_header(module)
+    owner = os.environ.get('PFSENSE_TRANSACTION')
+    try:
+        idle = time.time() - os.path.getmtime(queue_file)
+    except OSError:
+        return
+    if not header:
+        module.fail_json(msg='transaction queue without an id in '+queue_file+', abort it with pfsense_commit')
+    if owner and owner != header['transaction']:
+        module.fail_json(msg='transaction '+header['transaction']+' is not this run\'s ('+owner+'), abort it with pfsense_commit',
+                         transaction=header['transaction'], started=header.get('started'))
+    if not owner and idle > header.get('timeout', 3600):
+        module.fail_json(msg='transaction '+header['transaction']+' unused for %d seconds, abort it with pfsense_commit' % idle,
+                         transaction=header['transaction'], started=header.get('started'))
+    # still in use, the timeout starts over
+    try:
+        os.utime(queue_file, None)
+    except OSError:
+        pass
+
+
+def queue_config(module, configuration, post=""):
+    # one JSON line per write: the $config changes, and the post write_config() actions
+    try:
+        fd = os.open(queue_file, os.O_WRONLY | os.O_APPEND)
+        with timed('queue'), os.fdopen(fd, 'a') as f:
+            f.write(json.dumps(dict(php=configuration, post=post)) + "\n")
+    except (IOError, OSError) as e:
+        module.fail_json(msg='error queueing config in '+queue_file, error=str(e))
+
+
+def queued_config(module):
+    # list of pending writes in the current transaction, without the header line
+    queued = []
+    try:
+        with open(queue_file) as f:
+            for line in f:
+                if line.strip():
+                    queued.append(json.loads(line))
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg='error reading '+queue_file, error=str(e))
+    return [q for q in queued if 'transaction' not in q]
+
+
+def transaction_php(module):
+    # PHP bringing $txn['config'], the config with the queued writes applied, up to date and
+    # leaving it in $config. The shell keeps $txn between reads and a snapshot of it is left on
+    # the box for the next module, so each queued write only crosses the PHP channel once.
+    s = session(module)
+    txn = php_string(transaction_header(module).get('transaction', ''))
+    if s.replayed is None:
+        php = '$txn = @unserialize(@file_get_contents(' + php_string(snapshot_file) + '));\n' + \
+            "if (!is_array($txn) || $txn['transaction'] !== " + txn + ") $txn = ['transaction' => " + txn + ", 'count' => 0, 'config' => $config];\n" + \
+            'echo "\\n" . $txn[\'count\'] . "\\n";'
+        out = s.run(php, 'error reading transaction snapshot', 'read')
+        try:
+            s.replayed = int(out.strip())
+        except ValueError:
+            module.fail_json(msg='error reading transaction snapshot', output=out)
+    php = "$config = $txn['config'];\n"
+    queued = queued_config(module)
+    if len(queued) > s.replayed:
+        php += "\n".join(q['php'] for q in queued[s.replayed:]) + "\n"
+        php += "$txn['config'] = $config;\n$txn['count'] = " + str(len(queued)) + ";\n"
+        php += 'file_put_contents(' + php_string(snapshot_file + '.tmp') + ', serialize($txn));\n'
+        php += 'rename(' + php_string(snapshot_file + '.tmp') + ', ' + php_string(snapshot_file) + ');\n'
+        s.replayed = len(queued)
+    return php
+
+
+def config_revision():
+    # config.xml is replaced (new inode, size & mtime) every time write_config() saves a revision
+    try:
+        st = os.stat(config_file)
+    except OSError:
+        return None
+    return "%d:%d:%r" % (st.st_ino, st.st_size, st.st_mtime)
+
+
+def cache_file(section):
+    return os.path.join(cache_dir, (section or '_config').replace('/', '.') + '.json')
+
+
+def cache_get(section, revision):
+    if revision is None:
+        return False, None
+    try:
+        with timed('cache'), open(cache_file(section)) as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False, None
+    if cached.get('revision') != revision:
+        return False, None
+    return True, cached.get('data')
+
+
+def cache_put(section, revision, data):
+    # cached sections can hold keys & password hashes, keep them root only
+    if revision is None:
+        return
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        name = cache_file(section)
+        tmp = name + '.' + str(os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(revision=revision, data=data), f)
+        os.rename(tmp, name)
+    except (IOError, OSError):
+        pass
+
+
+def cache_clear():
+    try:
+        for name in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, name))
+    except (IOError, OSError):
+        pass
+
+
+def dirty_file(subsystem):
+    return os.path.join(state_dir, subsystem + '.dirty')
+
+
+def mark_dirty(subsystem, data=None):
+    # PHP to go with a write, noting what pfsense_apply will need to reconfigure.
+    # Each mark is one JSON line, appended so several tasks can add to it before an apply.
+    return "@mkdir('" + state_dir + "', 0700, true);\n" + \
+        "@file_put_contents('" + dirty_file(subsystem) + "', " + php_string(json.dumps(data)) + " . \"\\n\", FILE_APPEND);\n"
+
+
+def read_dirty(subsystem):
+    # list of the marks left for a subsystem, empty if it's clean
+    marks = []
+    try:
+        with open(dirty_file(subsystem)) as f:
+            for line in f:
+                if line.strip():
+                    marks.append(json.loads(line))
+    except (IOError, OSError, ValueError):
+        pass
+    return marks
+
+
+def clear_dirty(subsystem):
+    try:
+        os.remove(dirty_file(subsystem))
+    except OSError:
+        pass
+
+
+def config_path(section):
+    # 'system/group' -> $config['system']['group'], null if not set
+    path = "$config['" + "']['".join(section.split('/')) + "']"
+    return "(isset(" + path + ") ? " + path + " : null)"
+
+
+def php_string(s):
+    # PHP string expression, any character allowed. The shell reads requests line by line
+    # and a line of just exec or exit would end them, so line breaks go through JSON.
+    if '\n' in s or '\r' in s:
+        return "json_decode(" + php_string(json.dumps(s)) + ")"
+    return "'" + s.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def php_value(data):
+    # PHP expression for a value. Strings go as literals, anything else as one JSON
+    # document for PHP to json_decode(), so nothing needs quoting or validating.
+    if isstr(data):
+        return php_string(data)
+    return "json_decode(" + php_string(json.dumps(data)) + ", true)"
+
+
+def php_path(*keys):
+    # php_path('filter', 'rule', 3) -> $config['filter']['rule'][3], a key of '' appends
+    return "$config" + "".join("[]" if k == '' else "[" + (str(k) if type(k) is int else php_string(k)) + "]" for k in keys)
 
-    if section:
-        php = 'echo "\n".json_encode($config["'+section+'"])."\n";\nexec\nexit\n'
+
+def php_merge(path, data):
+    # PHP that sets the keys in data on the array at path, leaving its other keys alone
+    return path + " = array_replace(" + path + ", " + php_value(data) + ");\n"
+
+
+class ChangeSet(object):
+    # The changes a module makes to $config, kept as operations rather than PHP text.
+    # Paths are tuples of keys, e.g. ('filter', 'rule', 3). Operations on the same item
+    # are coalesced and php() emits them as one program: updates in the order they were
+    # first made, then removals with one array_values() per list, then appends.
+    # Indexes are those of the config as read, so a removal never shifts the next one.
+
+    def __init__(self):
+        self.updates = OrderedDict()    # path -> [kind, value, php], kind is set, update, replace or statement
+        self.unsets = OrderedDict()     # path -> reindex the list it's in
+        self.removals = OrderedDict()   # (list path, key) -> values to remove
+        self.appends = OrderedDict()    # list path -> items
+        self.statements = 0
+
+    def __len__(self):
+        return len(self.updates) + len(self.unsets) + len(self.removals) + len(self.appends)
+
+    def replaced(self, path):
+        # the replace or update operation holding path, if any
+        for i in range(len(path) - 1, 0, -1):
+            op = self.updates.get(path[:i])
+            if op is not None and op[0] in ['replace', 'update'] and (op[0] == 'replace' or i == len(path) - 1):
+                return path[:i], op
+        return None, None
+
+    def drop(self, path):
+        # forget earlier operations on path and anything below it
+        n = len(path)
+        for p in [p for p in self.updates if p[:n] == path and self.updates[p][0] != 'statement']:
+            del self.updates[p]
+        for p in [p for p in self.unsets if p[:n] == path]:
+            del self.unsets[p]
+
+    def set(self, path, value, php=None):
+        # $config at path = value. php, if given, is emitted instead of the assignment
+        # (e.g. a delta that gets there cheaper), value still tells apply() & changes() the outcome.
+        path = tuple(path)
+        at, op = self.replaced(path)
+        if op is not None and php is None:
+            if op[0] == 'replace':
+                target = op[1]
+                for key in path[len(at):-1]:
+                    target = target.setdefault(key, OrderedDict())
+                target[path[-1]] = value
+            else:
+                op[1][path[-1]] = value
+            return
+        self.drop(path)
+        self.updates[path] = ['set', value, php]
+
+    def update(self, path, fields):
+        # set some keys of the existing array at path, leaving its other keys alone
+        path = tuple(path)
+        at, op = self.replaced(path + ('',))
+        if op is not None:
+            for key, value in fields.items():
+                self.set(path + (key,), value)
+            return
+        for key in fields:
+            self.drop(path + (key,))
+        self.updates[path] = ['update', OrderedDict(fields), None]
+
+    def replace(self, path, item):
+        # the whole item at path, an index of '' appends
+        path = tuple(path)
+        if path[-1] == '':
+            return self.append(path[:-1], item)
+        self.drop(path)
+        self.updates[path] = ['replace', copy.deepcopy(item), None]
+
+    def unset(self, path, reindex=False):
+        # remove path, reindex when it's an item of a list
+        path = tuple(path)
+        self.drop(path)
+        self.unsets[path] = reindex
+
+    def append(self, path, item):
+        self.appends.setdefault(tuple(path), []).append(copy.deepcopy(item))
+
+    def remove(self, path, key, values):
+        # remove the items of the list at path whose key has one of values, wherever they are
+        self.removals.setdefault((tuple(path), key), set()).update(str(v) for v in values)
+
+    def statement(self, php):
+        # PHP with no config effect apply() could follow, run in order with the updates
+        self.statements += 1
+        self.updates[('', self.statements)] = ['statement', None, php]
+
+    def php(self):
+        out = []
+        for path, (kind, value, php) in self.updates.items():
+            if php is not None:
+                out.append(php if php.endswith("\n") else php + "\n")
+            elif kind == 'update' and len(value) > 1:
+                out.append(php_merge(php_path(*path), value))
+            elif kind == 'update':
+                for key, v in value.items():
+                    out.append(php_path(*(path + (key,))) + " = " + php_value(v) + ";\n")
+            else:
+                out.append(php_path(*path) + " = " + php_value(value) + ";\n")
+        reindex = []
+        for path, again in self.unsets.items():
+            out.append("unset(" + php_path(*path) + ");\n")
+            if again and path[:-1] not in reindex:
+                reindex.append(path[:-1])
+        for (path, key), values in self.removals.items():
+            # by key rather than position, so it's right even if the list moved since it was read
+            out.append("$remove = array_flip(" + php_value(sorted(values)) + ");\n")
+            out.append(php_path(*path) + " = array_values(array_filter(" + php_path(*path) + ", function($item) use ($remove) {\n")
+            out.append("    return !isset($remove[isset($item[" + php_string(key) + "]) ? $item[" + php_string(key) + "] : '']);\n")
+            out.append("}));\n")
+        for path in reindex:
+            out.append(php_path(*path) + " = array_values(" + php_path(*path) + ");\n")
+        for path, items in self.appends.items():
+            # empty sections come from config.xml as '', make sure each level is an array
+            for i in range(1, len(path) + 1):
+                out.append("if (!isset(" + php_path(*path[:i]) + ") || !is_array(" + php_path(*path[:i]) + ")) " + php_path(*path[:i]) + " = [];\n")
+            if len(items) == 1:
+                out.append(php_path(*(path + ('',))) + " = " + php_value(items[0]) + ";\n")
+            else:
+                out.append(php_path(*path) + " = array_merge(" + php_path(*path) + ", " + php_value(items) + ");\n")
+        return "".join(out)
+
+    def changes(self):
+        # the operations for --diff, cert & key bodies masked so only that they changed shows
+        def name(path):
+            return "/".join(str(k) for k in path)
+        out = []
+        for path, (kind, value, php) in self.updates.items():
+            if kind != 'statement':
+                out.append(dict(op=kind, path=name(path), value='<changed>' if path[-1] in blobs else mask_blobs(value)))
+        for path in self.unsets:
+            out.append(dict(op='unset', path=name(path)))
+        for (path, key), values in self.removals.items():
+            out.append(dict(op='remove', path=name(path), key=key, values=sorted(values)))
+        for path, items in self.appends.items():
+            for item in items:
+                out.append(dict(op='append', path=name(path), value=mask_blobs(item)))
+        return out
+
+    def apply(self, config):
+        # Make the same changes to config, a dict of the sections as read, in place.
+        # Returns config, now as the PHP will leave $config, so modules can return
+        # what they wrote without reading it back.
+        def get(node, key):
+            if type(node) is list:
+                return node[key] if type(key) is int and key < len(node) else None
+            return node.get(key) if isinstance(node, dict) else None
+
+        def walk(path, create=True):
+            node = config
+            for key in path[:-1]:
+                child = get(node, key)
+                if not isinstance(child, (dict, list)):
+                    if not create:
+                        return None
+                    child = OrderedDict()
+                    node[key] = child
+                node = child
+            return node
+
+        for path, (kind, value, php) in self.updates.items():
+            if kind == 'statement':
+                continue
+            node = walk(path)
+            if kind == 'update' and isinstance(get(node, path[-1]), dict):
+                node[path[-1]].update(copy.deepcopy(value))
+            elif kind == 'update':
+                node[path[-1]] = copy.deepcopy(value)
+            else:
+                node[path[-1]] = copy.deepcopy(value)
+        gone = OrderedDict()
+        for path in self.unsets:
+            node = walk(path, False)
+            if type(node) is list:
+                gone.setdefault(id(node), (node, set()))[1].add(path[-1])
+            elif isinstance(node, dict) and path[-1] in node:
+                del node[path[-1]]
+        for node, indexes in gone.values():
+            node[:] = [item for i, item in enumerate(node) if i not in indexes]
+        for (path, key), values in self.removals.items():
+            node = walk(path, False)
+            if type(get(node, path[-1])) is list:
+                node[path[-1]] = [item for item in node[path[-1]] if str(item.get(key, '')) not in values]
+        for path, items in self.appends.items():
+            node = walk(path)
+            if type(get(node, path[-1])) is not list:
+                node[path[-1]] = []
+            node[path[-1]].extend(copy.deepcopy(items))
+        return config
+
+
+def changes_result(module, result, changes):
+    # the change set, for ansible-playbook --diff
+    if getattr(module, '_diff', False) and len(changes):
+        result['changes'] = changes.changes()
+        result['diff'] = dict(prepared="\n".join(
+            c['op'] + " " + c['path'] + ("" if 'value' not in c else " = " + json.dumps(c['value'], sort_keys=True))
+            for c in result['changes']))
+    return result
+
+
+def php_read(module, sections, transaction=False, fingerprints=False):
+    # In a transaction the read is of $config with the queued writes applied, just for this read,
+    # so a read can see the queued changes without them taking effect.
+    # With fingerprints, the items of each section come with their crt & prv replaced by fingerprint().
+
+    wrap = (lambda p: '$fp(' + p + ')') if fingerprints else (lambda p: p)
+    if len(sections) == 1:
+        data = '$config' if sections[0] is None else wrap(config_path(sections[0]))
     else:
-        php = 'echo "\n".json_encode($config)."\n";\nexec\nexit\n'
+        data = '[' + ', '.join("'" + s + "'=>" + wrap(config_path(s)) for s in sections) + ']'
 
-    rc, out, err = module.run_command(cmd,data=php)
-    if rc != 0:
-        module.fail_json(msg='error reading config',error=err, output=out)
+    php = 'echo "\\n".json_encode(' + data + ')."\\n";'
+    if fingerprints:
+        php = '$fp = function($items) {\n' + \
+            '    if (!is_array($items)) return $items;\n' + \
+            '    foreach ($items as $k => $item) foreach (' + php_value(sorted(blobs)) + ' as $b)\n' + \
+            "        if (is_array($item) && isset($item[$b]) && is_string($item[$b])) $items[$k][$b] = 'sha256:'.hash('sha256', preg_replace('/\\s+/', '', $item[$b]));\n" + \
+            '    return $items;\n' + \
+            '};\n' + php + '\nunset($fp);'
+    if transaction:
+        php = '$saved_config = $config;\n' + transaction_php(module) + php + '\n$config = $saved_config;\nunset($saved_config);'
 
-    start = "\npfSense shell: exec\n"
-    end = "\npfSense shell: exit\n"
+    out = session(module).run(php, 'error reading config', 'read')
     try:
-        s = out.index(start) + len(start)
-        e = out.index(end)
-        return json.loads(out[s:e])
-    except:
-        module.fail_json(msg='error converting to JSON', json=out[s:e])
+        with timed('decode'):
+            cfg = json.loads(out)
+    except ValueError:
+        module.fail_json(msg='error converting to JSON', json=out)
+    if len(sections) == 1:
+        return {sections[0]: cfg}
+    return cfg
 
 
-def search(elements, key, val):
+def xml_value(elem):
+    # same shape as pfSense xml_to_array(): tags are lowercased, leaves are strings
+    # with whitespace only leaves as '', listtags are arrays
+    children = list(elem)
+    if not children:
+        text = (elem.text or '').strip('\t\n\r')
+        return text if text.strip() else ''
+    data = dict()
+    for child in children:
+        tag = child.tag.lower()
+        if tag in listtags:
+            data.setdefault(tag, []).append(xml_value(child))
+        else:
+            data[tag] = xml_value(child)
+    return data
+
+
+def xml_read(module, sections):
+    # Stream config.xml and only build the requested sections, instead of starting PHP
+
+    try:
+        if None in sections:
+            return {None: xml_value(ElementTree.parse(config_file).getroot())}
+
+        wanted = dict((tuple(s.split('/')), s) for s in sections)
+        cfg = dict((s, None) for s in sections)
+        pending = set(wanted)
+        path = []
+        root = None
+        for event, elem in ElementTree.iterparse(config_file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                else:
+                    path.append(elem.tag.lower())
+                continue
+            if elem is root:
+                break
+            key = tuple(path)
+            if key in wanted:
+                if elem.tag.lower() in listtags:
+                    cfg[wanted[key]] = (cfg[wanted[key]] or []) + [xml_value(elem)]
+                else:
+                    cfg[wanted[key]] = xml_value(elem)
+                    pending.discard(key)
+            # a list section is complete once its parent closes
+            pending = set(w for w in pending if w[:-1] != key)
+            path.pop()
+            if not pending:
+                break
+            if not path:
+                root.clear()
+        return cfg
+    except (IOError, OSError, ElementTree.ParseError) as e:
+        module.fail_json(msg='error parsing '+config_file, error=str(e))
+
+
+def read_config(module, section = None):
+    # section may be a single section name or a list of them,
+    # a list is fetched in one json_encode and returned as a dict keyed by section.
+    # Sections already cached on the box for the current config.xml revision don't touch PHP at all.
 
-    if type(elements) in [dict,list]:
-        for k,v in enumerate(elements):
-            if v[key] == val:
+    if section is None or isstr(section):
+        sections = [section]
+    else:
+        sections = list(section)
+
+    # in a transaction, read through PHP with the queued changes applied
+    if transaction_active():
+        cfg = php_read(module, sections, transaction=True)
+        if section is None or isstr(section):
+            return cfg[section]
+        return cfg
+
+    # take the revision before reading, so a config saved meanwhile only ever makes the cache miss
+    revision = config_revision()
+    cfg = dict()
+    missing = []
+    for s in sections:
+        hit, data = cache_get(s, revision)
+        if hit:
+            cfg[s] = data
+        else:
+            missing.append(s)
+
+    if missing:
+        if read_backend == 'xml':
+            with timed('xml'):
+                fetched = xml_read(module, missing)
+        else:
+            fetched = php_read(module, missing)
+        for s, data in fetched.items():
+            cache_put(s, revision, data)
+            cfg[s] = data
+
+    if section is None or isstr(section):
+        return cfg[section]
+    return cfg
+
+
+def fingerprint(blob):
+    # what a read with fingerprints gives for a crt or prv, whitespace in the base64 doesn't count
+    return 'sha256:' + hashlib.sha256(re.sub(r'\s+', '', blob).encode('utf-8')).hexdigest()
+
+
+def read_fingerprints(module, sections):
+    # Like read_config() for sections that are lists of certs (cert, ca), but each crt & prv
+    # comes as its fingerprint(), so key material doesn't cross the PHP channel just to be compared.
+    # Returns a dict keyed by section.
+
+    def local(data):
+        if type(data) is not list:
+            return data
+        return [dict((k, fingerprint(v) if k in blobs and isstr(v) else v) for k, v in item.items())
+                if isinstance(item, dict) else item for item in data]
+
+    if transaction_active():
+        return php_read(module, sections, transaction=True, fingerprints=True)
+
+    # the cache or config.xml already on the box can be hashed here instead
+    revision = config_revision()
+    cfg = dict()
+    missing = []
+    for s in sections:
+        hit, data = cache_get(s, revision)
+        if hit:
+            cfg[s] = local(data)
+        else:
+            missing.append(s)
+    if missing and read_backend == 'xml':
+        with timed('xml'):
+            fetched = xml_read(module, missing)
+        for s, data in fetched.items():
+            cache_put(s, revision, data)
+            cfg[s] = local(data)
+    elif missing:
+        cfg.update(php_read(module, missing, fingerprints=True))
+    return cfg
+
+
+def php_json(data):
+    # the same text PHP's json_encode() gives for decoded config data
+    return json.dumps(data, separators=(',', ':')).replace('/', '\\/')
+
+
+def verify_config(module, section, data):
+    # Check a write landed by comparing a hash of the section on the firewall
+    # with the state the module worked out, instead of reading the section back.
+    if transaction_active():
+        return
+    php = 'echo "\\n".sha1(json_encode(' + config_path(section) + '))."\\n";'
+    out = session(module).run(php, 'error verifying config', 'verify').strip()
+    if out != hashlib.sha1(php_json(data).encode('utf-8')).hexdigest():
+        module.fail_json(msg='config verification failed for section: '+section)
+
+
+def strip_blobs(data):
+    # Copy of config data without certificate & key bodies
+    if isinstance(data, dict):
+        return dict((k, strip_blobs(v)) for k, v in data.items() if k not in blobs)
+    if type(data) is list:
+        return [strip_blobs(v) for v in data]
+    return data
+
+
+def mask_blobs(data):
+    # Copy of config data with certificate & key bodies as '<changed>'
+    if isinstance(data, dict):
+        return dict((k, '<changed>' if k in blobs else mask_blobs(v)) for k, v in data.items())
+    if type(data) is list:
+        return [mask_blobs(v) for v in data]
+    return data
+
+
+def return_state(module, result, key, section, item):
+    # Put the module's state in the result as return_state asks: the whole
+    # section, just the item(s) the task touched, or nothing at all.
+    state = module.params.get('return_state', 'item')
+    with timed('emit'):
+        if state == 'section':
+            result[key] = strip_blobs(section)
+        elif state == 'item':
+            result[key] = strip_blobs(item)
+
+
+class Index(object):
+    # Lookup table over a config collection (rules, aliases, certs, ...),
+    # built once per key so repeated lookups don't rescan the whole list.
+    # Items missing the key are skipped, the first item with a given value wins like search() always did.
+
+    def __init__(self, elements, *keys):
+        if type(elements) is list:
+            self.items = list(enumerate(elements))
+        elif type(elements) is dict:
+            self.items = list(elements.items())
+        else:
+            self.items = []
+        self.tables = dict()
+        for key in keys:
+            self.table(key)
+
+    def table(self, key):
+        if key not in self.tables:
+            table = dict()
+            for k, v in self.items:
+                if type(v) is dict and key in v and type(v[key]) not in [dict,list]:
+                    table.setdefault(str(v[key]), k)
+            self.tables[key] = table
+        return self.tables[key]
+
+    def find(self, *criteria):
+        # criteria are (key, value) pairs tried in order, e.g. ('uniqid',x), ('subnet',y)
+        for key, val in criteria:
+            if val is None:
+                continue
+            k = self.table(key).get(str(val))
+            if k is not None:
                 return k
-    return ""
+        return ""
+
+    def add(self, key, val, k):
+        self.table(key).setdefault(str(val), k)
 
 
-def pfsense_check(module):
-    # Make sure we're actually targeting a pfSense firewall
+def search(elements, key, val):
+
+    return Index(elements).find((key, val))
+
+
+def pfsense_check(module, transaction=True):
+    # Make sure we're actually targeting a pfSense firewall, and any transaction queue is ours
     if not os.path.isfile(cmd):
         module.fail_json(msg='pfSense shell not found at '+cmd)
     if platform.system() != "FreeBSD":
         module.fail_json(msg='pfSense platform expected: FreeBSD found: '+platform.system())
+    if transaction:
+        transaction_check(module)
 
 
 def validate(module,message,data,regex="^[^']*$"):
@@ -76,3 +897,48 @@ def validate(module,message,data,regex="^[^']*$"):
                 return
             else:
                 module.fail_json(msg='invalid data in parameter: '+message)
+
+
+def item_params(module, spec, item, name, nulls=()):
+    # Apply an argument_spec to one entry of a list parameter (e.g. rules:, aliases:)
+    # like AnsibleModule does for top level options. Unknown keys are ignored.
+    # Keys in nulls given without a value (log: in yaml) come as '', the way an empty
+    # xml element reads, rather than None as if they were left out.
+    if type(item) is not dict:
+        module.fail_json(msg='each entry in '+name+' must be a dict', item=item)
+    params = dict()
+    for key, arg in spec.items():
+        val = item.get(key, arg.get('default'))
+        if val is None and key in nulls and key in item:
+            val = ''
+        if type(val) in [int, float]:
+            val = str(val)
+        if val is None:
+            if arg.get('required'):
+                module.fail_json(msg=name+': missing required key: '+key, item=item)
+        elif 'choices' in arg and val not in arg['choices']:
+            module.fail_json(msg=name+': value of '+key+' must be one of: '+', '.join(str(c) for c in arg['choices']), item=item)
+        elif arg.get('type') in [dict, 'dict'] and type(val) is not dict:
+            module.fail_json(msg=name+': '+key+' must be a dict', item=item)
+        elif arg.get('type') in [list, 'list'] and type(val) is not list:
+            module.fail_json(msg=name+': '+key+' must be a list', item=item)
+        params[key] = val
+    return params
+
+
+def bulk_items(module, spec, name, key, nulls=()):
+    # The entries a task works through: each one in the list option name (bulk mode, e.g. rules:)
+    # checked by item_params(), or else the task's own options. Like with_items, a later entry
+    # with the same key(entry) wins over an earlier one, which is dropped. nulls as for item_params().
+    params = module.params
+    if params[name] is None:
+        todo = [dict((p, params[p]) for p in spec)]
+        if nulls:
+            # module.params has None for an option left out too, the arguments as given tell them apart
+            from ansible.module_utils.basic import _load_params
+            given = _load_params()
+            todo[0].update((p, '') for p in nulls if p in given and given[p] is None)
+    else:
+        todo = [item_params(module, spec, item, name, nulls) for item in params[name]]
+    last = dict((key(item), i) for i, item in enumerate(todo))
+    return [item for i, item in enumerate(todo) if last[key(item)] == i]
@@ -0,0 +1,51 @@
+# vim: set expandtab:
+
+# Loading the modules in library/ the way ansible would, with module_utils/pfsense.py as
+# ansible.module_utils.pfsense, and running one on a set of arguments. For the tests that need
+# ansible-core, like bench/bench.py; basic is None without it.
+
+import contextlib
+import importlib
+import importlib.util
+import io
+import json
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+try:
+    import ansible.module_utils
+    from ansible.module_utils import basic
+except ImportError:
+    basic = None
+
+
+def load(name):
+    # the module, pfsense.py is loaded once so every module shares it
+    if 'ansible.module_utils.pfsense' not in sys.modules:
+        spec = importlib.util.spec_from_file_location('ansible.module_utils.pfsense', os.path.join(root, 'module_utils', 'pfsense.py'))
+        pfsense = importlib.util.module_from_spec(spec)
+        sys.modules['ansible.module_utils.pfsense'] = pfsense
+        ansible.module_utils.pfsense = pfsense
+        spec.loader.exec_module(pfsense)
+        sys.path.insert(0, os.path.join(root, 'library'))
+    return importlib.import_module(name)
+
+
+def pfsense():
+    return sys.modules['ansible.module_utils.pfsense']
+
+
+def run(module, args):
+    # the module's result, what it exited or failed with
+    basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=args)).encode('utf-8')
+    basic._ANSIBLE_PROFILE = 'legacy'   # ansible-core 2.19 wants one, older ones ignore it
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            module.main()
+        except SystemExit:
+            pass
+    return json.loads(out.getvalue().strip().split('\n')[-1])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# vim: set expandtab:
+
+# Stand-in for /usr/local/sbin/pfSsh.php that needs no PHP, for tests/test_pfssh.py.
+# Like the real shell it prompts before every line it reads, collects lines until
+# "exec" and quits on "exit". What it runs is a handful of PHP statements:
+#
+#   echo "text\n";                       prints the text, \n as a line break
+#   echo "\n" . getmypid() . "\n";       prints its pid, to tell processes apart
+#   echo "\n" . implode("-", ["@@pfsense", "1", "begin@@"]) . "\n";   the session's markers
+#   fwrite(STDERR, "text");              prints to stderr
+#   exit(N);                             quits with status N, in the middle of a request
+#
+# With PFSSH_ECHO set it also echoes each line it reads after the prompt, as a terminal would.
+
+import os
+import re
+import sys
+
+prompt = "pfSense shell: "
+
+frame = re.compile(r'^echo "\\n" \. implode\("-", \["@@pfsense", "([0-9]+)", "([a-z]+)@@"\]\) \. "\\n";$')
+pid = re.compile(r'^echo "\\n" \. getmypid\(\) \. "\\n";$')
+echo = re.compile(r'^echo "(.*)";$')
+stderr = re.compile(r'^fwrite\(STDERR, "(.*)"\);$')
+exit = re.compile(r'^exit\(([0-9]+)\);$')
+
+
+def text(s):
+    return s.replace('\\n', '\n')
+
+
+def run(buffer):
+    for line in buffer:
+        line = line.strip()
+        m = frame.match(line)
+        if m:
+            sys.stdout.write("\n@@pfsense-" + m.group(1) + "-" + m.group(2) + "@@\n")
+        elif pid.match(line):
+            sys.stdout.write("\n%d\n" % os.getpid())
+        elif echo.match(line):
+            sys.stdout.write(text(echo.match(line).group(1)))
+        elif stderr.match(line):
+            sys.stderr.write(text(stderr.match(line).group(1)))
+        elif exit.match(line):
+            sys.stdout.flush()
+            sys.exit(int(exit.match(line).group(1)))
+        elif line:
+            sys.stdout.write("\nPHP Parse error: " + line + "\n")
+    sys.stdout.flush()
+
+
+sys.stdout.write("\nStarting the pfSense developer shell....\n")
+buffer = []
+while True:
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if line == '':
+        break
+    if os.environ.get('PFSSH_ECHO'):
+        sys.stdout.write(line)
+    command = line.strip()
+    if command == 'exit':
+        break
+    if command in ['exec', 'exec;']:
+        run(buffer)
+        buffer = []
+    else:
+        buffer.append(line)
@@ -0,0 +1,113 @@
+# vim: set expandtab:
+
+# pfsense_apply's background jobs: the state job_result() reports for a job's status file, pid
+# and start time, without running any job.
+#
+#   python -m pytest tests/      (needs ansible-core, like bench/bench.py)
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from ansible_modules import basic, load
+
+apply = None
+
+
+def setUpModule():
+    global apply
+    if basic is not None:
+        apply = load('pfsense_apply')
+
+
+class Exited(Exception):
+    pass
+
+
+class Module(object):
+    def exit_json(self, **kwargs):
+        raise Exited(kwargs)
+
+    def fail_json(self, **kwargs):
+        raise Exited(kwargs)
+
+
+@unittest.skipIf(basic is None, 'needs ansible')
+class JobResultTest(unittest.TestCase):
+
+    job = '20260101000000-1'
+
+    def setUp(self):
+        self.saved = apply.jobs_dir
+        apply.jobs_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(apply.jobs_dir)
+        apply.jobs_dir = self.saved
+
+    def status(self, **status):
+        with open(apply.job_file(self.job, '.json'), 'w') as f:
+            json.dump(dict(dict(job=self.job, services=[]), **status), f)
+
+    def result(self):
+        with self.assertRaises(Exited) as e:
+            apply.job_result(Module(), dict(changed=False), self.job)
+        return e.exception.args[0]
+
+    def dead_pid(self):
+        proc = subprocess.Popen([sys.executable, '-c', ''])
+        proc.wait()
+        return proc.pid
+
+    def test_running(self):
+        self.status(state='running', started=time.time(), pid=os.getpid())
+        self.assertEqual(self.result()['state'], 'running')
+
+    def test_pid_file(self):
+        # daemon(8)'s pid file stands in until the job saves its own status
+        self.status(state='running', started=time.time() - 3600)
+        with open(apply.job_file(self.job, '.pid'), 'w') as f:
+            f.write('%d\n' % os.getpid())
+        self.assertEqual(self.result()['state'], 'running')
+        with open(apply.job_file(self.job, '.pid'), 'w') as f:
+            f.write('%d\n' % self.dead_pid())
+        self.assertEqual(self.result()['error'], 'job is gone')
+
+    def test_never_started(self):
+        self.status(state='running', started=time.time())
+        self.assertEqual(self.result()['state'], 'running')
+        self.status(state='running', started=time.time() - apply.job_timeout - 1)
+        result = self.result()
+        self.assertEqual(result['state'], 'failed')
+        self.assertEqual(result['error'], 'job never started')
+
+    def test_finished_meanwhile(self):
+        # the process is gone because it's done, the status read again says so
+        self.status(state='running', started=time.time(), pid=self.dead_pid())
+        saved = apply.job_status
+        reads = []
+
+        def job_status(job):
+            reads.append(job)
+            if len(reads) > 1:
+                self.status(state='done', started=time.time() - 1, finished=time.time(), pid=1)
+            return saved(job)
+        apply.job_status = job_status
+        try:
+            result = self.result()
+        finally:
+            apply.job_status = saved
+        self.assertEqual(result['state'], 'done')
+        self.assertIn('seconds', result)
+
+    def test_no_such_job(self):
+        self.assertEqual(self.result()['msg'], 'no such job: ' + self.job)
+
+
+if __name__ == '__main__':
+    unittest.main()
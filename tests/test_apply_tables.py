@@ -0,0 +1,123 @@
+# vim: set expandtab:
+
+# pfsense_apply's alias tables: the pf tables it replaces with tests/stand-ins/pfctl, which logs
+# what it is given and refuses tables whose name starts with reject, and the aliases it leaves
+# to a filter reload.
+#
+#   python -m pytest tests/      (needs ansible-core, like bench/bench.py)
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ansible_modules import basic, here, load, pfsense, run
+
+apply = None
+
+
+def setUpModule():
+    global apply
+    if basic is not None:
+        apply = load('pfsense_apply')
+
+
+aliases = [
+    dict(name='Web', type='host', address='192.0.2.10 192.0.2.11'),
+    dict(name='Nets', type='network', address='10.0.0.0/8 2001:db8::/32'),
+    dict(name='Named', type='host', address='www.example.com'),
+    dict(name='Range', type='network', address='192.0.2.1-192.0.2.9'),
+    dict(name='Servers', type='host', address='Web 192.0.2.20'),
+    dict(name='Ports', type='port', address='80 443'),
+    dict(name='reject_me', type='host', address='192.0.2.30'),
+]
+
+
+@unittest.skipIf(basic is None, 'needs ansible')
+class AliasTablesTest(unittest.TestCase):
+
+    class Session(object):
+        def __init__(self):
+            self.php = []
+
+        def run(self, php, msg='', phase='php'):
+            self.php.append(php)
+            return ''
+
+    def setUp(self):
+        self.state = tempfile.mkdtemp()
+        os.environ['PFCTL_LOG'] = os.path.join(self.state, 'pfctl.log')
+        self.session = self.Session()
+        self.saved = dict((name, getattr(apply, name)) for name in ['pfctl', 'read_config', 'pfsense_check'])
+        self.saved_utils = dict((name, getattr(pfsense(), name)) for name in ['state_dir', 'queue_file', 'cache_dir', 'session'])
+        apply.pfctl = os.path.join(here, 'stand-ins', 'pfctl')
+        apply.read_config = lambda module, section: dict(alias=aliases)
+        apply.pfsense_check = lambda module: None
+        pfsense().state_dir = self.state
+        pfsense().queue_file = os.path.join(self.state, 'transaction.queue')
+        pfsense().cache_dir = os.path.join(self.state, 'cache')
+        pfsense().session = lambda module: self.session
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(apply, name, value)
+        for name, value in self.saved_utils.items():
+            setattr(pfsense(), name, value)
+        shutil.rmtree(self.state)
+
+    def mark(self, *names):
+        # the marks pfsense_aliases leaves, in place of the ones there were
+        with open(os.path.join(self.state, 'aliases.dirty'), 'w') as f:
+            for name in names:
+                f.write(json.dumps(dict(name=name)) + '\n')
+
+    def replaced(self):
+        if not os.path.exists(os.environ['PFCTL_LOG']):
+            return []
+        with open(os.environ['PFCTL_LOG']) as f:
+            return f.read().splitlines()
+
+    def filter_reloaded(self):
+        return any('filter_configure();' in php for php in self.session.php)
+
+    def test_replace(self):
+        self.mark('Nets', 'Web', 'Nets')
+        self.assertIsNone(apply.alias_tables(None))
+        self.mark('Nets')
+        self.assertEqual(apply.alias_tables(None), [('Nets', ['10.0.0.0/8', '2001:db8::/32'])])
+        result = run(apply, dict(services='aliases'))
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['tables'], ['Nets'])
+        self.assertEqual(self.replaced(), ['Nets: 10.0.0.0/8 2001:db8::/32 '])
+        self.assertFalse(self.filter_reloaded())
+        self.assertFalse(os.path.exists(os.path.join(self.state, 'aliases.dirty')))
+
+    def test_nested(self):
+        # Servers lists Web, its table holds Web's addresses too
+        self.mark('Web')
+        self.assertIsNone(apply.alias_tables(None))
+        result = run(apply, dict(services='aliases'))
+        self.assertEqual(result['tables'], [])
+        self.assertEqual(self.replaced(), [])
+        self.assertTrue(self.filter_reloaded())
+
+    def test_expanded(self):
+        # hostnames, ranges and nested aliases only pfSense can turn into addresses
+        for name in ['Named', 'Range', 'Servers', 'Ports', 'Missing']:
+            self.mark(name)
+            self.assertIsNone(apply.alias_tables(None), name)
+        run(apply, dict(services='aliases'))
+        self.assertEqual(self.replaced(), [])
+        self.assertTrue(self.filter_reloaded())
+        self.assertFalse(os.path.exists(os.path.join(self.state, 'aliases.dirty')))
+
+    def test_refused(self):
+        self.mark('reject_me')
+        run(apply, dict(services='aliases'))
+        self.assertEqual(self.replaced(), ['reject_me: 192.0.2.30 '])
+        self.assertTrue(self.filter_reloaded())
+
+
+if __name__ == '__main__':
+    unittest.main()
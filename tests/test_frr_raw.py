@@ -0,0 +1,155 @@
+# vim: set expandtab:
+
+# pfsense_frr_raw's incremental reload: the vtysh commands frr_commands() works out, and a module
+# run against bench/vtysh, which logs what it is given and refuses lines holding "bench-reject".
+#
+#   python -m pytest tests/      (needs ansible-core, like bench/bench.py)
+
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+
+from ansible_modules import basic, root, load, pfsense, run
+
+frr = None
+
+
+def setUpModule():
+    global frr
+    if basic is not None:
+        frr = load('pfsense_frr_raw')
+
+
+bgpd = """router bgp 64512
+ bgp router-id 192.0.2.1
+ neighbor 10.0.0.1 remote-as 64513
+ neighbor 10.0.0.1 description one
+ neighbor 10.0.0.2 remote-as 64514
+ neighbor 10.0.0.2 description two
+ !
+ address-family ipv4 unicast
+  network 192.0.2.0/24
+  neighbor 10.0.0.1 activate
+  neighbor 10.0.0.2 activate
+ exit-address-family
+!
+line vty
+!
+"""
+
+
+def b64(text):
+    return base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+
+@unittest.skipIf(basic is None, 'needs ansible')
+class FrrCommandsTest(unittest.TestCase):
+
+    def test_unchanged(self):
+        self.assertEqual(frr.frr_commands(bgpd, bgpd), [])
+        self.assertEqual(frr.frr_hash(bgpd), frr.frr_hash(bgpd.replace('\n!\n', '\n! a comment\n\n')))
+
+    def test_changed_line(self):
+        self.assertEqual(frr.frr_commands(bgpd, bgpd.replace('description two', 'description 2')), [
+            'configure terminal', 'router bgp 64512',
+            'no neighbor 10.0.0.2 description two', 'neighbor 10.0.0.2 description 2',
+            'end'])
+
+    def test_nested(self):
+        new = bgpd.replace('  network 192.0.2.0/24\n', '  network 198.51.100.0/24\n')
+        self.assertEqual(frr.frr_commands(bgpd, new), [
+            'configure terminal', 'router bgp 64512', 'address-family ipv4 unicast',
+            'no network 192.0.2.0/24', 'network 198.51.100.0/24',
+            'end'])
+
+    def test_negated(self):
+        # a line that goes is negated, a "no" line that goes is put back
+        old = bgpd.replace(' bgp router-id 192.0.2.1\n', ' bgp router-id 192.0.2.1\n no bgp ebgp-requires-policy\n')
+        self.assertEqual(frr.frr_commands(old, bgpd), [
+            'configure terminal', 'router bgp 64512', 'bgp ebgp-requires-policy', 'end'])
+
+    def test_readded(self):
+        # negating remote-as drops the whole neighbor, what's kept of it goes back in, address-family too
+        new = bgpd.replace('10.0.0.1 remote-as 64513', '10.0.0.1 remote-as 64515')
+        self.assertEqual(frr.frr_commands(bgpd, new), [
+            'configure terminal', 'router bgp 64512',
+            'no neighbor 10.0.0.1 remote-as 64513',
+            'neighbor 10.0.0.1 remote-as 64515', 'neighbor 10.0.0.1 description one',
+            'end',
+            'configure terminal', 'router bgp 64512', 'address-family ipv4 unicast',
+            'neighbor 10.0.0.1 activate',
+            'end'])
+
+    def test_removed_node(self):
+        # only the node itself is negated, not what's under it
+        old = bgpd + 'router ospf\n network 10.0.0.0/8 area 0\n'
+        self.assertEqual(frr.frr_commands(old, bgpd), ['configure terminal', 'no router ospf', 'end'])
+
+
+@unittest.skipIf(basic is None, 'needs ansible')
+class FrrReloadTest(unittest.TestCase):
+
+    class Session(object):
+        def __init__(self):
+            self.php = []
+
+        def run(self, php, msg='', phase='php'):
+            self.php.append(php)
+            return ''
+
+    def setUp(self):
+        self.state = tempfile.mkdtemp()
+        os.environ['PFSENSE_BENCH_STATE'] = self.state
+        self.session = self.Session()
+        self.saved = dict((name, getattr(frr, name)) for name in ['vtysh', 'frr_inc', 'read_config', 'session', 'pfsense_check'])
+        frr.vtysh = os.path.join(root, 'bench', 'vtysh')
+        frr.frr_inc = os.path.join(root, 'bench', 'inc', 'frr.inc')
+        frr.read_config = lambda module, section: dict(
+            frr=dict(config=[dict(enable='on', password='secret')]),
+            frrbgp=dict(config=[dict(enable='on')]),
+            frrglobalraw=dict(config=[dict(bgpd=b64(bgpd))]))
+        frr.session = lambda module: self.session
+        frr.pfsense_check = lambda module: None
+        # write_config() goes through session() in module_utils
+        pfsense().session = frr.session
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(frr, name, value)
+        pfsense().session = self.saved['session']
+        shutil.rmtree(self.state)
+
+    def pushed(self):
+        with open(os.path.join(self.state, 'vtysh.log')) as f:
+            return f.read().splitlines()
+
+    def test_incremental(self):
+        result = run(frr, dict(bgpd=b64(bgpd.replace('description one', 'description 1'))))
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['reload'], 'incremental')
+        self.assertEqual(self.pushed(), result['vtysh'])
+        self.assertIn('neighbor 10.0.0.1 description 1', self.pushed())
+        # and saved for the daemons' next start
+        self.assertEqual(self.pushed()[-1], 'write memory')
+        # the package sections are left alone, frr_generate_config() isn't run
+        self.assertNotIn("['frr']", result['phpcode'])
+        self.assertFalse(any('frr_generate_config' in php for php in self.session.php))
+
+    def test_unchanged(self):
+        result = run(frr, dict(bgpd=b64(bgpd + '!\n')))
+        self.assertFalse(result['changed'])
+        self.assertFalse(os.path.exists(os.path.join(self.state, 'vtysh.log')))
+
+    def test_rejected(self):
+        result = run(frr, dict(bgpd=b64(bgpd.replace('router-id 192.0.2.1', 'router-id bench-reject'))))
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['reload'], 'full')
+        self.assertIn('bgp router-id bench-reject', self.pushed())
+        self.assertNotIn('write memory', self.pushed())
+        self.assertIn('frr_generate_config();', self.session.php[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# vim: set expandtab:
+
+# The PfSsh session's framing against tests/stand-ins/pfSsh.py, a shell that prompts, collects
+# lines until exec and runs a few PHP statements without needing PHP.
+#
+#   python -m pytest tests/      or      python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'module_utils'))
+
+import pfsense
+
+stand_in = os.path.join(here, 'stand-ins', 'pfSsh.py')
+
+
+class Failed(Exception):
+    pass
+
+
+class Module(object):
+    def fail_json(self, **kwargs):
+        raise Failed(kwargs)
+
+
+class PfSshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = pfsense.PfSsh(Module(), stand_in)
+
+    def tearDown(self):
+        self.session.close()
+        os.environ.pop('PFSSH_ECHO', None)
+
+    def test_round_trip(self):
+        self.assertEqual(self.session.run('echo "\\nhello\\n";'), 'hello\n')
+        self.assertIn('php', pfsense.timings)
+
+    def test_one_process(self):
+        first = self.session.run('echo "\\n" . getmypid() . "\\n";')
+        second = self.session.run('echo "\\n" . getmypid() . "\\n";')
+        self.assertEqual(first, second)
+        self.assertEqual(self.session.serial, 2)
+        self.assertEqual(self.session.run('echo "\\none\\n";\necho "two\\n";'), 'one\ntwo\n')
+
+    def test_echoed_lines(self):
+        # the source lines, markers' included, come back after the prompt and are dropped,
+        # the blank lines the shell's output starts with are left for the callers to strip
+        os.environ['PFSSH_ECHO'] = '1'
+        self.assertEqual(self.session.run('echo "\\nhello\\n";').strip(), 'hello')
+        self.assertEqual(self.session.run('echo "\\nagain\\n";').strip(), 'again')
+
+    def test_exit_status(self):
+        self.session.run('echo "\\nfine\\n";')
+        with self.assertRaises(Failed) as e:
+            self.session.run('echo "\\nhalf\\n";\nfwrite(STDERR, "broken");\nexit(3);', 'error writing config')
+        failure = e.exception.args[0]
+        self.assertEqual(failure['msg'], 'error writing config')
+        self.assertEqual(failure['rc'], 3)
+        self.assertEqual(failure['error'], 'broken')
+        self.assertIn('half', failure['output'])
+        # the next request starts a new shell
+        self.assertIsNone(self.session.proc)
+        self.assertEqual(self.session.run('echo "\\nback\\n";'), 'back\n')
+
+    def test_eof(self):
+        # exiting with status 0 mid-request still fails the request
+        with self.assertRaises(Failed) as e:
+            self.session.run('exit(0);')
+        self.assertEqual(e.exception.args[0]['rc'], 0)
+
+    def test_missing_shell(self):
+        session = pfsense.PfSsh(Module(), os.path.join(here, 'stand-ins', 'missing'))
+        self.assertRaises(Failed, session.run, 'echo "\\nhello\\n";')
+
+
+if __name__ == '__main__':
+    unittest.main()
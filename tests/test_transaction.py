@@ -0,0 +1,117 @@
+# vim: set expandtab:
+
+# Transactions in module_utils: which run a queue belongs to, and reads replaying only the writes
+# queued since the last one, against a session that records the PHP it is given.
+#
+#   python -m pytest tests/      or      python -m unittest discover tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'module_utils'))
+
+import pfsense
+
+
+class Failed(Exception):
+    pass
+
+
+class Session(object):
+    # the snapshot holds none of the queue, reads give an empty section
+    def __init__(self):
+        self.php = []
+        self.replayed = None
+
+    def run(self, php, msg='', phase='php'):
+        self.php.append(php)
+        return '\n0\n' if phase == 'read' and 'file_get_contents' in php else '\n{}\n'
+
+
+class Module(object):
+    def __init__(self):
+        self._pfsense_session = Session()
+
+    def fail_json(self, **kwargs):
+        raise Failed(kwargs)
+
+
+class TransactionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(pfsense, name)) for name in ['queue_file', 'snapshot_file'])
+        pfsense.queue_file = os.path.join(self.state, 'transaction.queue')
+        pfsense.snapshot_file = os.path.join(self.state, 'transaction.snapshot')
+        os.environ.pop('PFSENSE_TRANSACTION', None)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(pfsense, name, value)
+        os.environ.pop('PFSENSE_TRANSACTION', None)
+        shutil.rmtree(self.state)
+
+    def begin(self, header):
+        # what pfsense_commit state=begin leaves
+        with open(pfsense.queue_file, 'w') as f:
+            f.write(json.dumps(header) + '\n' if header else '')
+
+    def test_owner(self):
+        self.begin(dict(transaction='1-1', started=time.time(), timeout=3600))
+        pfsense.transaction_check(Module())
+        os.environ['PFSENSE_TRANSACTION'] = '1-1'
+        pfsense.transaction_check(Module())
+        os.environ['PFSENSE_TRANSACTION'] = '2-2'
+        with self.assertRaises(Failed) as e:
+            pfsense.transaction_check(Module())
+        self.assertEqual(e.exception.args[0]['transaction'], '1-1')
+
+    def test_stale(self):
+        self.begin(dict(transaction='1-1', started=time.time() - 7200, timeout=3600))
+        os.utime(pfsense.queue_file, (time.time() - 7200, time.time() - 7200))
+        self.assertRaises(Failed, pfsense.transaction_check, Module())
+        # the run that began it still owns it
+        os.environ['PFSENSE_TRANSACTION'] = '1-1'
+        pfsense.transaction_check(Module())
+        # and using it starts the timeout over
+        os.environ.pop('PFSENSE_TRANSACTION')
+        pfsense.transaction_check(Module())
+
+    def test_no_header(self):
+        # a queue from before transactions had ids
+        self.begin(None)
+        self.assertRaises(Failed, pfsense.transaction_check, Module())
+
+    def test_no_transaction(self):
+        os.environ['PFSENSE_TRANSACTION'] = '1-1'
+        pfsense.transaction_check(Module())
+
+    def test_replay(self):
+        self.begin(dict(transaction='1-1', started=time.time(), timeout=3600))
+        module = Module()
+        pfsense.queue_config(module, "$config['a'] = 'first';")
+        self.assertEqual(pfsense.queued_config(module), [dict(php="$config['a'] = 'first';", post='')])
+        pfsense.read_config(module, 'a')
+        self.assertIn("'1-1'", module._pfsense_session.php[0])
+        self.assertIn("'first'", module._pfsense_session.php[1])
+        # nothing new, nothing replayed
+        pfsense.read_config(module, 'a')
+        self.assertNotIn("'first'", module._pfsense_session.php[2])
+        self.assertIn("$config = $txn['config'];", module._pfsense_session.php[2])
+        # only what was queued since
+        pfsense.queue_config(module, "$config['a'] = 'second';")
+        pfsense.read_fingerprints(module, ['a'])
+        self.assertNotIn("'first'", module._pfsense_session.php[3])
+        self.assertIn("'second'", module._pfsense_session.php[3])
+        self.assertIn("$txn['count'] = 2;", module._pfsense_session.php[3])
+        self.assertEqual(len(module._pfsense_session.php), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
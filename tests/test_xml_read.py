@@ -0,0 +1,70 @@
+# vim: set expandtab:
+
+# The config.xml read backend against what pfSsh.php's json_encode($config) gives for the same
+# config.xml, recorded in fixtures/config.json.
+#
+#   python -m pytest tests/      or      python -m unittest discover tests
+
+import json
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'module_utils'))
+
+import pfsense
+
+
+class Failed(Exception):
+    pass
+
+
+class Module(object):
+    def fail_json(self, **kwargs):
+        raise Failed(kwargs)
+
+
+def php_section(cfg, section):
+    # what config_path() gives PHP for a section, None where it isn't set
+    for key in section.split('/'):
+        if not isinstance(cfg, dict) or key not in cfg:
+            return None
+        cfg = cfg[key]
+    return cfg
+
+
+class XmlReadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config_file = pfsense.config_file
+        pfsense.config_file = os.path.join(here, 'fixtures', 'config.xml')
+        with open(os.path.join(here, 'fixtures', 'config.json')) as f:
+            self.php = json.load(f)
+
+    def tearDown(self):
+        pfsense.config_file = self.config_file
+
+    def test_whole_config(self):
+        self.assertEqual(pfsense.xml_read(Module(), [None]), {None: self.php})
+
+    def test_sections(self):
+        sections = ['system', 'system/group', 'system/nextgid', 'system/dnsserver', 'filter', 'aliases',
+                    'interfaces', 'installedpackages', 'nat', 'system/user']
+        cfg = pfsense.xml_read(Module(), sections)
+        for s in sections:
+            self.assertEqual(cfg[s], php_section(self.php, s), s)
+
+    def test_leaves(self):
+        cfg = pfsense.xml_read(Module(), ['interfaces/lan', 'filter/rule'])
+        self.assertEqual(cfg['interfaces/lan']['spoofmac'], '')
+        self.assertEqual(cfg['interfaces/lan']['enable'], '')
+        self.assertEqual(cfg['filter/rule'][1]['descr'], 'Mixed case tag')
+
+    def test_missing_file(self):
+        pfsense.config_file = os.path.join(here, 'fixtures', 'missing.xml')
+        self.assertRaises(Failed, pfsense.xml_read, Module(), ['filter'])
+
+
+if __name__ == '__main__':
+    unittest.main()